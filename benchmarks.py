@@ -0,0 +1,291 @@
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import tempfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import data_collector
+import weather
+import forecast_service
+from explanation import NO_EXPLANATION
+
+########################################################################
+#
+#   Project: Forecast Benchmarks
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Times the hot paths of the project on synthetic data and prints
+#   the results as JSON:
+#
+#       python benchmarks.py --output results.json
+#       python benchmarks.py --baseline results.json
+#
+#   Station files in the NCEI format are generated into a temporary
+#   folder and reduced by data_collector.py, and the forecasts run on
+#   the climatology built from them, with the real zip code and
+#   elevation tables. With --baseline, any benchmark whose median time
+#   is more than --tolerance times the baseline's is reported and the
+#   script exits with status 1.
+#
+########################################################################
+
+# Synthetic data
+DEFAULT_YEARS = 2
+DEFAULT_STATIONS = 20
+DEFAULT_ROWS = 2920  # observations per station file (3-hourly for a year)
+DEFAULT_SEED = 0
+
+# Timing
+DEFAULT_REPEAT = 5  # runs of each benchmark; the median is what gets compared
+DEFAULT_SAMPLES = 1000  # zip codes used by the per-call benchmarks
+DEFAULT_TOLERANCE = 1.25  # a median this many times the baseline's is a regression
+
+FORECAST_DATE = '2024-05-14'
+
+NCEI_HEADER = ('"STATION","DATE","SOURCE","LATITUDE","LONGITUDE","ELEVATION","NAME","REPORT_TYPE","CALL_SIGN",'
+               '"QUALITY_CONTROL","WND","CIG","VIS","TMP","DEW","SLP"\n')
+
+# Write `stations` synthetic NCEI station files with `rows` observations each into one
+# folder per year, like weather_database. Each station keeps its position and temperature
+# from one year to the next. With shuffle, the rows of each file are written in random
+# order. Returns the number of observations written.
+def generate_station_files(database, years=DEFAULT_YEARS, stations=DEFAULT_STATIONS, rows=DEFAULT_ROWS,
+                           seed=DEFAULT_SEED, compress=False, shuffle=False):
+    rng = random.Random(seed)
+    sites = [(rng.uniform(-60, 70), rng.uniform(-170, 170), rng.uniform(0, 2500), rng.randint(-200, 300))
+             for _ in range(stations)]
+    temps = [site[3] for site in sites]
+    shuffle_rng = random.Random(seed + 1)  # separate, so shuffling leaves the data itself unchanged
+    total = 0
+    for year in range(2020 - years + 1, 2021):
+        year_folder = os.path.join(database, str(year))
+        os.makedirs(year_folder, exist_ok=True)
+        for station, (latitude, longitude, elevation, _) in enumerate(sites):
+            station_id = f"{station:06d}99999"
+            temp = temps[station]
+            start = datetime(year, 1, 1)
+            step = (datetime(year + 1, 1, 1) - start) / rows
+
+            lines = [NCEI_HEADER]
+            for row in range(rows):
+                temp = max(-600, min(500, temp + rng.randint(-15, 15)))
+                # about 2% missing and 10% erroneous temperatures, as in the real archive
+                tmp = "+9999" if rng.random() < 0.02 else f"{temp:+05d}"
+                quality = '3' if rng.random() < 0.1 else '1'
+                date = start + step * row
+                lines.append(f'"{station_id}","{date:%Y-%m-%dT%H:%M:%S}","4","{latitude:.7f}","{longitude:.7f}",'
+                             f'"{elevation:.1f}","STATION {station}, XX","FM-12","99999","V020","320,1,N,0077,1",'
+                             f'"99999,9,9,N","005000,1,9,9","{tmp},{quality}","-0091,1","10010,1"\n')
+            temps[station] = temp
+            if shuffle:
+                body = lines[1:]
+                shuffle_rng.shuffle(body)
+                lines[1:] = body
+
+            path = os.path.join(year_folder, station_id + ".csv")
+            if compress:
+                with gzip.open(path + ".gz", 'wt') as f:
+                    f.writelines(lines)
+            else:
+                with open(path, 'w') as f:
+                    f.writelines(lines)
+            total += rows
+    return total
+
+# run fn `repeat` times, returning the seconds each run took
+def time_runs(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+# summary of the run times of one benchmark, with per-item rates when each run handles `items` items
+def summarize(times, items=None, unit='items'):
+    result = {
+        'runs': len(times),
+        'median_s': statistics.median(times),
+        'min_s': min(times),
+        'max_s': max(times),
+    }
+    if items:
+        result[unit] = items
+        result[f'{unit}_per_s'] = items / result['median_s']
+        result['median_us_per_item'] = result['median_s'] / items * 1e6
+    return result
+
+# Point weather.py at the climatology files in averages_dir
+def use_averages(averages_dir):
+    weather.CLIMATOLOGY_FILE = os.path.join(averages_dir, data_collector.CLIMATOLOGY_FILENAME)
+    weather.REGIONAL_CLIMATOLOGY_FILE = os.path.join(averages_dir, data_collector.REGIONAL_FILENAME)
+    weather.REGIONAL_CELLS_FILE = os.path.join(averages_dir, data_collector.REGIONAL_CELLS_FILENAME)
+    weather.YEARLY_TOTALS_FILE = os.path.join(averages_dir, data_collector.YEARLY_FILENAME)
+    weather.SNAPSHOT_FILE = os.path.join(averages_dir, os.path.basename(weather.SNAPSHOT_FILE))
+
+def bench_ingest(database, observations, workers, repeat):
+    times = time_runs(lambda: data_collector.collect_totals(database, workers), repeat)
+    return summarize(times, observations, 'rows')
+
+def bench_load(repeat):
+    def load():
+        index = weather.LocationIndex.from_files(weather.ZIP_CODE_FILE, weather.ELEVATION_FILE)
+        index.elevation_index()
+    return summarize(time_runs(load, repeat))
+
+def bench_coordinates(zip_codes, repeat):
+    def lookup():
+        for zip_code in zip_codes:
+            weather.get_coordinates(zip_code)
+    return summarize(time_runs(lookup, repeat), len(zip_codes), 'calls')
+
+def bench_elevation(coordinates, repeat):
+    def lookup():
+        for latitude, longitude in coordinates:
+            weather.get_elevation(latitude, longitude)
+    return summarize(time_runs(lookup, repeat), len(coordinates), 'calls')
+
+# single predictions, first with an empty forecast cache and then again with every location cached
+def bench_predict(coordinates, repeat):
+    def predict():
+        for latitude, longitude in coordinates:
+            weather.predict_temperature(latitude, longitude, 20.0, FORECAST_DATE[5:], 'Clear', NO_EXPLANATION)
+
+    cold = []
+    warm = []
+    for _ in range(repeat):
+        weather.clear_forecast_cache()
+        cold += time_runs(predict, 1)
+        warm += time_runs(predict, 1)
+    return {'cold': summarize(cold, len(coordinates), 'calls'), 'warm': summarize(warm, len(coordinates), 'calls')}
+
+# what the GUI does for one submission: zip code lookup and a 6-day forecast, starting from an empty cache
+# (with days=366, a year-long horizon instead)
+def bench_forecast(zip_codes, repeat, days=6):
+    zip_codes = zip_codes[:100]
+    def run():
+        for zip_code in zip_codes:
+            forecast_service.forecast_for_zip(zip_code, 20.0, 'Clear', FORECAST_DATE, days)
+
+    times = []
+    for _ in range(repeat):
+        weather.clear_forecast_cache()
+        times += time_runs(run, 1)
+    return summarize(times, len(zip_codes), 'forecasts')
+
+# one prediction for every zip code in a single vectorized call
+def bench_batch(repeat):
+    coordinates = np.array(list(weather.get_location_index().zip_codes.values()), dtype=float)
+    count = len(coordinates)
+    temps = np.full(count, 20.0)
+    days = np.full(count, FORECAST_DATE[5:])
+    states = np.full(count, 'Clear')
+    times = time_runs(lambda: weather.predict_temperature_batch(coordinates[:, 0], coordinates[:, 1], temps, days, states), repeat)
+    return summarize(times, count, 'predictions')
+
+# run every benchmark, returning the JSON report
+def run_benchmarks(years=DEFAULT_YEARS, stations=DEFAULT_STATIONS, rows=DEFAULT_ROWS, repeat=DEFAULT_REPEAT,
+                   samples=DEFAULT_SAMPLES, workers=data_collector.DEFAULT_WORKERS, seed=DEFAULT_SEED):
+    random.seed(seed)
+    workdir = tempfile.mkdtemp(prefix='weather-benchmarks-')
+    try:
+        database = os.path.join(workdir, 'weather_database')
+        averages = os.path.join(workdir, 'averages')
+        os.mkdir(averages)
+
+        observations = generate_station_files(database, years, stations, rows, seed)
+        results = {'ingest': bench_ingest(database, observations, workers, repeat)}
+        data_collector.write_outputs(data_collector.collect_totals(database, workers), averages)
+        use_averages(averages)
+
+        results['load_locations'] = bench_load(repeat)
+        # zip codes with no elevation data nearby cannot be forecast, so they are left out
+        location_index = weather.get_location_index()
+        forecastable = [zip_code for zip_code, (latitude, longitude) in sorted(location_index.zip_codes.items())
+                        if location_index.interpolated_elevation(latitude, longitude) is not None]
+        zip_codes = random.Random(seed).sample(forecastable, samples)
+        coordinates = [weather.get_coordinates(zip_code) for zip_code in zip_codes]
+        results['get_coordinates'] = bench_coordinates(zip_codes, repeat)
+        results['get_elevation'] = bench_elevation(coordinates, repeat)
+        results['predict_temperature'] = bench_predict(coordinates, repeat)
+        results['forecast_6_day'] = bench_forecast(zip_codes, repeat)
+        results['forecast_366_day'] = bench_forecast(zip_codes, repeat, 366)
+        results['all_zip_batch'] = bench_batch(repeat)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'parameters': {'years': years, 'stations': stations, 'rows': rows, 'repeat': repeat,
+                       'samples': samples, 'workers': workers, 'seed': seed},
+        'results': results,
+    }
+
+# (name, summary) for every benchmark summary in a report, with nested ones named 'outer.inner'
+def flatten_results(results, prefix=''):
+    for name, result in results.items():
+        if 'median_s' in result:
+            yield prefix + name, result
+        else:
+            yield from flatten_results(result, f'{prefix}{name}.')
+
+# benchmarks whose median time is more than `tolerance` times the baseline's
+def find_regressions(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    baseline_results = dict(flatten_results(baseline['results']))
+    regressions = []
+    for name, result in flatten_results(report['results']):
+        if name in baseline_results and result['median_s'] > baseline_results[name]['median_s'] * tolerance:
+            regressions.append((name, baseline_results[name]['median_s'], result['median_s']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest, lookups and forecasts on synthetic data.")
+    parser.add_argument('--years', type=int, default=DEFAULT_YEARS, help="year folders of station files to generate")
+    parser.add_argument('--stations', type=int, default=DEFAULT_STATIONS, help="station files per year")
+    parser.add_argument('--rows', type=int, default=DEFAULT_ROWS, help="observations per station file")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="runs of each benchmark")
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES, help="zip codes used by the per-call benchmarks")
+    parser.add_argument('--workers', type=int, default=data_collector.DEFAULT_WORKERS, help="collector worker processes")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    parser.add_argument('--baseline', help="JSON report of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help="slowdown factor reported as a regression")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.years, args.stations, args.rows, args.repeat, args.samples, args.workers, args.seed)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        for name, before, after in regressions:
+            print(f"Regression in {name}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+########################################################################
+#
+#   Project: Forecast Cache
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   A thread-safe, size-bounded least-recently-used cache with hit,
+#   miss and eviction counters.
+#
+#   Callers compute missing values outside the lock: read
+#   `generation`, lookup() the key, and on a miss compute the value and
+#   put() it with that generation. clear() starts a new generation, and
+#   a value computed in an older generation (from data that has since
+#   changed) is not stored.
+#
+########################################################################
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = 0  # incremented by clear()
+
+    # cached value for key, or None on a miss
+    def lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    # store value for key, evicting the least recently used entries beyond maxsize.
+    # generation is self.generation from before the value was computed; if the cache
+    # has been cleared since, the value is dropped.
+    def put(self, key, value, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    # drop every entry and start a new generation (the counters are kept)
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self.entries), 'maxsize': self.maxsize}
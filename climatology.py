@@ -0,0 +1,220 @@
+import os
+
+import numpy as np
+
+from locations import SpatialIndex
+
+########################################################################
+#
+#   Project: Weather Climatology
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Day-of-year helpers and the binary climatology file shared by
+#   data_collector.py (which writes it) and weather.py (which reads it).
+#   The climatology is a fixed 366-row table, one row per day of a
+#   leap year, so a day is looked up by its integer offset.
+#
+#   The regional climatology keeps the same averages per grid cell.
+#   Only (cell, day) pairs with observations are stored, sorted by a
+#   combined cell/day key, with a small table of the cells themselves.
+#   A location and day are looked up from its nearest cells.
+#
+#   The yearly totals keep the raw daily totals of every year, a
+#   (years, 366, 5) cube of about 15 KB per year, so a climatology over
+#   a window of years or with recent years weighted more can be
+#   computed without rereading the station files.
+#
+########################################################################
+
+# every date is mapped onto a leap year so that Feb 29 gets its own row
+DAYS_IN_YEAR = 366
+DAYS_IN_MONTH = [31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+MONTH_OFFSETS = np.cumsum([0] + DAYS_IN_MONTH[:-1])
+DAY_KEYS = [f"{month}-{day}" for month, days in enumerate(DAYS_IN_MONTH, start=1) for day in range(1, days + 1)]
+
+# columns of a daily totals table (one row per day of the year)
+CHANGE, LATITUDE, LONGITUDE, ELEVATION, COUNT = range(5)
+
+# one row of the climatology file: averages of every observation for that day
+CLIMATOLOGY_DTYPE = np.dtype([
+    ('change', '<f8'),     # average temperature change in °C
+    ('latitude', '<f8'),   # midpoint latitude of the contributing stations
+    ('longitude', '<f8'),  # midpoint longitude of the contributing stations
+    ('elevation', '<f8'),  # average elevation in meters
+    ('count', '<i8'),      # number of observations
+])
+
+# map month and day numbers (scalars or arrays) to a row of the climatology
+def day_index(month, day):
+    return MONTH_OFFSETS[month - 1] + day - 1
+
+# year and climatology row of datetime64[D] dates (arrays)
+def calendar_days(dates):
+    months = dates.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]').astype(np.int64) + 1970
+    month_numbers = months.astype(np.int64) % 12 + 1
+    days_of_month = (dates - months).astype(np.int64) + 1
+    return years, day_index(month_numbers, days_of_month)
+
+# one row of the regional climatology: averages for one grid cell and day
+REGIONAL_DTYPE = np.dtype([('key', '<i8')] + CLIMATOLOGY_DTYPE.descr)  # key = cell position * 366 + day
+
+# one grid cell of the regional climatology, positioned at the average of its observations
+REGIONAL_CELL_DTYPE = np.dtype([
+    ('cell', '<i8'),       # grid cell id (see cell_id)
+    ('latitude', '<f8'),
+    ('longitude', '<f8'),
+    ('count', '<i8'),
+])
+
+# id of the grid cell (cell_size degrees square) containing points (scalars or arrays)
+def cell_id(latitude, longitude, cell_size):
+    lat_cells = int(np.ceil(180 / cell_size))
+    lon_cells = int(np.ceil(360 / cell_size))
+    rows = np.clip(np.floor((np.asarray(latitude) + 90) / cell_size).astype(np.int64), 0, lat_cells - 1)
+    cols = np.floor((np.asarray(longitude) + 180) / cell_size).astype(np.int64) % lon_cells
+    return rows * lon_cells + cols
+
+# turn a (366, 5) daily totals table into the climatology table (days without data are NaN)
+def build_climatology(daily_totals):
+    climatology = np.zeros(DAYS_IN_YEAR, dtype=CLIMATOLOGY_DTYPE)
+    count = daily_totals[:, COUNT]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        climatology['change'] = daily_totals[:, CHANGE] / count
+        climatology['latitude'] = daily_totals[:, LATITUDE] / count
+        climatology['longitude'] = daily_totals[:, LONGITUDE] / count
+        climatology['elevation'] = daily_totals[:, ELEVATION] / count
+    climatology['count'] = count
+    return climatology
+
+# turn {cell: (366, 5) daily totals} into the regional climatology rows and cell table
+def build_regional_climatology(regional_totals):
+    cells = np.zeros(len(regional_totals), dtype=REGIONAL_CELL_DTYPE)
+    rows = []
+    for position, cell in enumerate(sorted(regional_totals)):
+        daily_totals = regional_totals[cell]
+        count = daily_totals[:, COUNT].sum()
+        cells[position] = (cell, daily_totals[:, LATITUDE].sum() / count, daily_totals[:, LONGITUDE].sum() / count, count)
+
+        days = np.flatnonzero(daily_totals[:, COUNT])
+        cell_rows = np.zeros(len(days), dtype=REGIONAL_DTYPE)
+        cell_rows['key'] = position * DAYS_IN_YEAR + days
+        climatology = build_climatology(daily_totals)[days]
+        for name in CLIMATOLOGY_DTYPE.names:
+            cell_rows[name] = climatology[name]
+        rows.append(cell_rows)
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=REGIONAL_DTYPE)
+    return rows, cells
+
+def write_regional_climatology(rows, cells, rows_path, cells_path):
+    np.save(rows_path, rows)
+    np.save(cells_path, cells)
+
+# memory-map the regional climatology, or None if it has not been built
+def load_regional_climatology(rows_path, cells_path):
+    if not (os.path.exists(rows_path) and os.path.exists(cells_path)):
+        return None
+    return RegionalClimatology(np.load(rows_path, mmap_mode='r'), np.load(cells_path, mmap_mode='r'))
+
+# Regional climatology lookups: a location's value for a day is the inverse-distance-weighted
+# average of its nearest cells that have observations for that day
+class RegionalClimatology:
+    # cells closer than this (km) are weighted as if they were this far away
+    MINIMUM_DISTANCE_KM = 1.0
+
+    def __init__(self, rows, cells):
+        self.rows = rows
+        self.cells = cells
+        self.index = SpatialIndex(cells['latitude'], cells['longitude'], np.arange(len(cells)))
+
+    def __len__(self):
+        return len(self.cells)
+
+    # climatology rows (CLIMATOLOGY_DTYPE) for arrays of points and day offsets; count is 0 where no nearby cell has data
+    def lookup(self, latitudes, longitudes, days, k):
+        latitudes, longitudes, days = np.broadcast_arrays(np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float), np.asarray(days))
+        shape = latitudes.shape
+        result = np.zeros(latitudes.size, dtype=CLIMATOLOGY_DTYPE)
+        for name in ('change', 'latitude', 'longitude', 'elevation'):
+            result[name] = np.nan
+        if len(self) == 0 or len(self.rows) == 0:
+            return result.reshape(shape)
+
+        # nearest cells of every distinct location
+        points, point_positions = np.unique(np.column_stack([latitudes.ravel(), longitudes.ravel()]), axis=0, return_inverse=True)
+        cell_positions, distances = self.index.nearest_batch(points[:, 0], points[:, 1], k)
+        cell_positions = cell_positions[point_positions.ravel()]
+        distances = distances[point_positions.ravel()]
+
+        # find each (cell, day) row by its key
+        keys = cell_positions * DAYS_IN_YEAR + days.reshape(-1, 1)
+        row_positions = np.minimum(np.searchsorted(self.rows['key'], keys), len(self.rows) - 1)
+        rows = self.rows[row_positions]
+        found = rows['key'] == keys
+
+        weights = np.where(found, 1 / np.maximum(distances, self.MINIMUM_DISTANCE_KM) ** 2, 0)
+        total_weight = weights.sum(axis=1)
+        has_data = total_weight > 0
+        for name in ('change', 'latitude', 'longitude', 'elevation'):
+            values = np.where(found, rows[name], 0)
+            result[name][has_data] = (weights * values).sum(axis=1)[has_data] / total_weight[has_data]
+        result['count'] = np.where(found, rows['count'], 0).sum(axis=1)
+        return result.reshape(shape)
+
+def write_climatology(climatology, path):
+    np.save(path, climatology)
+
+# memory-map the climatology file (read only)
+def load_climatology(path):
+    return np.load(path, mmap_mode='r')
+
+# one row of the yearly totals file: the (366, 5) daily totals table of one year
+YEARLY_DTYPE = np.dtype([('year', '<i8'), ('totals', '<f8', (DAYS_IN_YEAR, 5))])
+
+# turn {year: (366, 5) daily totals} into the yearly totals rows, sorted by year
+def build_yearly_totals(yearly_totals):
+    rows = np.zeros(len(yearly_totals), dtype=YEARLY_DTYPE)
+    for position, year in enumerate(sorted(yearly_totals)):
+        rows[position] = (year, yearly_totals[year])
+    return rows
+
+def write_yearly_totals(rows, path):
+    np.save(path, rows)
+
+# memory-map the yearly totals file (read only)
+def load_yearly_totals(path):
+    return np.load(path, mmap_mode='r')
+
+# raise ValueError unless window (years) is None or at least 1 and half_life (years) is None or positive
+def check_climatology_window(window=None, half_life=None):
+    if window is not None and window < 1:
+        raise ValueError(f"The climatology window must be at least 1 year, not {window}")
+    if half_life is not None and not half_life > 0:
+        raise ValueError(f"The climatology half-life must be a positive number of years, not {half_life}")
+
+# Climatology from the yearly totals, counting years up to reference_year (default: the latest year).
+# window: only the last `window` years; half_life: weight each year by 0.5 ** (age in years / half_life).
+# The count column is the number of observations used, before weighting.
+# Raises ValueError for an invalid window or half-life, or when no year is selected.
+def yearly_climatology(yearly_totals, window=None, half_life=None, reference_year=None):
+    check_climatology_window(window, half_life)
+    years = np.asarray(yearly_totals['year'])
+    if reference_year is None:
+        reference_year = years.max() if len(years) else 0
+    ages = reference_year - years
+
+    selected = ages >= 0
+    if window is not None:
+        selected &= ages < window
+    if not selected.any():
+        raise ValueError("No years of station data fall in the climatology window")
+    totals = np.asarray(yearly_totals['totals'][selected])
+    weights = np.ones(len(totals)) if half_life is None else 0.5 ** (ages[selected] / half_life)
+
+    climatology = build_climatology(np.tensordot(weights, totals, axes=1))
+    climatology['count'] = totals[..., COUNT].sum(axis=0)
+    return climatology
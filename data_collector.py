@@ -1,6 +1,23 @@
 import os
 import csv
-from datetime import datetime, timedelta
+import json
+import itertools
+import sqlite3
+import logging
+import argparse
+from functools import partial as bind
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+from instrumentation import timed, count
+
+from climatology import (DAYS_IN_YEAR, DAY_KEYS, CHANGE, LATITUDE, LONGITUDE, ELEVATION, COUNT,
+                         calendar_days, cell_id, build_climatology, write_climatology,
+                         build_regional_climatology, write_regional_climatology, build_yearly_totals, write_yearly_totals)
 
 
 ########################################################################
@@ -22,126 +39,436 @@ from datetime import datetime, timedelta
 #
 ######################################################################
 
-# function to get the month and day from a date string
-def get_month_day(date_string):
-    date_obj = get_date_obj(date_string)
-    return "{:02d}-{:02d}".format(date_obj.month, date_obj.day)
-
-def get_date_obj(date_string):
-    date_obj = datetime.strptime(date_string, "%Y-%m-%dT%H:%M:%S")
-    return date_obj;
+logger = logging.getLogger(__name__)
 
 # set the path for the weather_database folder
-weather_db_path = "weather_database"
-
-# create a dictionary to store the daily average temperature change for each day of the year
-daily_averages = {}
-
-# helper variables for storing last temp
-last_temp = 0;
-last_date_key = "None"
-
-# iterate over each year folder
-for year_folder in os.listdir(weather_db_path):
-    # get the path for the year folder
-    year_folder_path = os.path.join(weather_db_path, year_folder)
-    
-    # skip any files that are not directories
-    if not os.path.isdir(year_folder_path):
-        continue
-    
-    print("Processing year folder:", year_folder_path)
-    
-    # iterate over each CSV file in the year folder
-    for csv_file in os.listdir(year_folder_path):
-        # get the path for the CSV file
-        csv_file_path = os.path.join(year_folder_path, csv_file)
-        
-        # skip any files that are not CSV files
-        if not csv_file.endswith(".csv"):
+WEATHER_DB_PATH = "weather_database"
+
+# set the path for the output file
+OUTPUT_DIR = "averages"
+OUTPUT_FILENAME = "average.csv"
+CLIMATOLOGY_FILENAME = "climatology.npy"
+REGIONAL_FILENAME = "regional.npy"
+REGIONAL_CELLS_FILENAME = "regional_cells.npy"
+YEARLY_FILENAME = "yearly.npy"
+
+# size in degrees of the grid cells stations are bucketed into for the regional climatology
+DEFAULT_CELL_SIZE = 1.0
+
+# number of worker processes used to reduce station files (None = one per core)
+DEFAULT_WORKERS = None
+
+# store of per-file partial aggregates, so reruns only reduce new or changed station files
+STATE_FILENAME = "partials.sqlite"
+STATE_VERSION = 4  # bumped whenever the stored partials change shape
+
+# station files may be stored plain or gzip-compressed
+STATION_FILE_EXTENSIONS = (".csv", ".csv.gz")
+
+# rows read from a station file at a time; bounds the memory used per file
+STATION_CHUNK_ROWS = 100_000
+
+# find every station CSV file in the weather database, sorted by path
+def find_station_files(weather_db_path):
+    station_files = []
+
+    # iterate over each year folder
+    for year_folder in sorted(os.listdir(weather_db_path)):
+        # get the path for the year folder
+        year_folder_path = os.path.join(weather_db_path, year_folder)
+
+        # skip any files that are not directories
+        if not os.path.isdir(year_folder_path):
             continue
-        
-        print("Processing CSV file:", csv_file_path)
-        
-        # open the CSV file and read its contents
-        with open(csv_file_path, newline='') as csvfile:
-            csvreader = csv.reader(csvfile, delimiter='\t', lineterminator='\0')
-            next(csvreader) # skip the header row
-    
-            # iterate over each row in the CSV file
-            for row in csvreader:
-                # check if the row has enough columns
-                if len(row) < 1:
-                    print("Skipping row with not enough columns:", row)
-                    continue
-
-                # extract temperature values
-                data = arr = row[0].split(',')
-                tmp_str = data[24].replace('"', '')
-                quality_code = int(data[25].replace('"', ''))
-                temp = float(tmp_str) / 10;
-
-                cur_latitude = float(data[3].replace('"', ''))
-                cur_longitude = float(data[4].replace('"', ''))
-                cur_elevation = float(data[5].replace('"', ''))
-
-                #Check if the temperature is erroneous
-                if(quality_code == 3):
-                    continue;
-
-                # extract date values
-                date_str = data[1].replace('"', '')
-                date_obj = get_date_obj(date_str)
-                date_key = str(date_obj.month) + "-" + str(date_obj.day)
-
-                # find temperature change between this day and the last
-                if((last_temp == 9999)):
-                    change = 0;
-                else:
-                    change = temp - last_temp
-
-                # replace old last values
-                last_date_key = date_key
-                last_temp = temp
-
-                # calculate the temperature change from the previous day, if available
-                if date_key in daily_averages:
-                    prev_total_change_str, prev_lat, prev_long, prev_elev, prev_count = daily_averages[date_key]
-                    prev_total_change = float(prev_total_change_str)
-                    #print("Prev total: ", prev_total_change)
-                    total_change = change + prev_total_change
-                    total_latitude = prev_lat + cur_latitude
-                    total_longitude = prev_long + cur_longitude
-                    total_elevation = prev_elev + cur_elevation
-                    count = prev_count + 1
+
+        logger.info("Processing year folder: %s", year_folder_path)
+
+        # iterate over each CSV file in the year folder
+        for csv_file in sorted(os.listdir(year_folder_path)):
+            # skip any files that are not CSV files
+            if not csv_file.endswith(STATION_FILE_EXTENSIONS):
+                continue
+
+            station_files.append(os.path.join(year_folder_path, csv_file))
+
+    return sorted(station_files)
+
+# columns read from each NCEI station file
+STATION_COLUMNS = ['DATE', 'LATITUDE', 'LONGITUDE', 'ELEVATION', 'TMP']
+
+# NCEI marks a missing temperature with this value, and erroneous ones with this quality code
+MISSING_TEMP = 9999
+ERRONEOUS_QUALITY_CODE = '3'
+
+# A station file is reduced by a chain of generators, each pulling one batch of rows at a
+# time from the stage before it, so no more than one chunk of a file is ever in memory:
+#
+#   read_station_chunks -> parse_observations -> filter_observations -> reduce_days -> daily_changes -> aggregate_observations
+#
+# reduce_days groups the observations by calendar day, so they may come in any order. The
+# temperature change of a day is the change in the station's mean temperature from the day
+# before; a day whose previous day has no observations has no change.
+
+# read a station file (plain or .gz) as DataFrames of at most chunk_rows rows
+def read_station_chunks(csv_file_path, chunk_rows=STATION_CHUNK_ROWS):
+    with pd.read_csv(csv_file_path, usecols=STATION_COLUMNS, dtype={'TMP': str, 'DATE': str},
+                     chunksize=chunk_rows, compression='infer') as reader:
+        while True:
+            with timed('ingest_read'):
+                frame = next(reader, None)
+            if frame is None:
+                return
+            count('station_rows', len(frame))
+            yield frame
+
+# convert each chunk into typed arrays
+def parse_observations(chunks):
+    for frame in chunks:
+        with timed('ingest_parse'):
+            batch = parse_frame(frame)
+        yield batch
+
+# typed arrays of one chunk of a station file
+def parse_frame(frame):
+    # TMP holds the temperature (tenths of °C) and its quality code, e.g. "+0150,1"
+    tmp = frame['TMP'].str.split(',', n=1, expand=True).reindex(columns=[0, 1])
+    dates = pd.to_datetime(frame['DATE'], format="%Y-%m-%dT%H:%M:%S", errors='coerce')
+    return {
+        'date': dates.to_numpy(dtype='datetime64[D]'),
+        'temp': pd.to_numeric(tmp[0], errors='coerce').to_numpy(dtype=float),
+        'quality': tmp[1].to_numpy(),
+        'latitude': frame['LATITUDE'].to_numpy(dtype=float),
+        'longitude': frame['LONGITUDE'].to_numpy(dtype=float),
+        'elevation': frame['ELEVATION'].to_numpy(dtype=float),
+    }
+
+# drop erroneous and missing temperatures and rows that could not be parsed
+# (temperatures stay in tenths of °C, so summing them is exact in any order)
+def filter_observations(batches):
+    for batch in batches:
+        with timed('ingest_filter'):
+            valid = ((batch['quality'] != ERRONEOUS_QUALITY_CODE) & (batch['temp'] != MISSING_TEMP)
+                     & ~np.isnan(batch['temp']) & ~np.isnat(batch['date'])
+                     & ~np.isnan(batch['latitude']) & ~np.isnan(batch['longitude']) & ~np.isnan(batch['elevation']))
+            observations = {
+                'date': batch['date'][valid],
+                'temp': batch['temp'][valid],
+                'latitude': batch['latitude'][valid],
+                'longitude': batch['longitude'][valid],
+                'elevation': batch['elevation'][valid],
+            }
+        yield observations
+
+# columns of the running per-day sums in reduce_days
+DAILY_COLUMNS = ['temp', 'latitude', 'longitude', 'elevation']
+
+# reduce a station's observations to one row per calendar day, sorted by date: the mean temperature
+# (°C), latitude, longitude and elevation. Each batch is grouped by date and merged into the running
+# per-day sums, which are at most a few hundred rows for a station year. None if nothing was observed.
+def reduce_days(batches):
+    dates = np.empty(0, dtype='datetime64[D]')
+    sums = np.empty((0, len(DAILY_COLUMNS) + 1))  # the daily columns, then the number of observations
+    for batch in batches:
+        with timed('ingest_daily'):
+            observations = np.column_stack([batch[column] for column in DAILY_COLUMNS] + [np.ones(len(batch['date']))])
+            dates, positions = np.unique(np.concatenate([dates, batch['date']]), return_inverse=True)
+            rows = np.concatenate([sums, observations])
+            sums = np.column_stack([np.bincount(positions, weights=rows[:, column], minlength=len(dates))
+                                    for column in range(rows.shape[1])])
+
+    if len(dates) == 0:
+        return None
+    means = sums[:, :-1] / sums[:, -1:]
+    days = {'date': dates}
+    days.update(zip(DAILY_COLUMNS, means.T))
+    days['temp'] = days['temp'] / 10
+    return days
+
+# the change of every day from the station's previous day, for days whose previous day was observed
+def daily_changes(days):
+    if days is None:
+        return
+    follows = np.diff(days['date']).astype(np.int64) == 1
+    years, day_indices = calendar_days(days['date'][1:][follows])
+    yield {
+        'year': years,
+        'day': day_indices,
+        'change': np.diff(days['temp'])[follows],
+        'latitude': days['latitude'][1:][follows],
+        'longitude': days['longitude'][1:][follows],
+        'elevation': days['elevation'][1:][follows],
+    }
+
+# partial aggregates of one station file: the grid cells and years its observations fall in, and a
+# (cells, years, 366, 5) table of [total change, total latitude, total longitude, total elevation, count].
+# station and edges (the station's first and last observed day in the file, see day_edges) let
+# StationTotals add the change across the boundary between two files of the same station.
+StationPartial = namedtuple('StationPartial', ['cells', 'years', 'totals', 'station', 'edges'], defaults=(None, None))
+
+# station id of an NCEI station file: its name without the extension (weather_database/<year>/<station>.csv)
+def station_id(csv_file_path):
+    return os.path.basename(csv_file_path).split('.', 1)[0]
+
+# the first and last row of a station's days as [[days since 1970, temp, latitude, longitude, elevation], ...]
+def day_edges(days):
+    if days is None:
+        return np.empty((0, 5))
+    edges = np.column_stack([days['date'].astype(np.int64)] + [days[column] for column in DAILY_COLUMNS])
+    return edges[[0, -1]].astype(float)
+
+# group-reduce every batch by grid cell, year and day of the year into a StationPartial
+def aggregate_observations(batches, cell_size=DEFAULT_CELL_SIZE):
+    pair_totals = {}  # (cell, year) -> (366, 5) totals
+    for batch in batches:
+        with timed('ingest_aggregate'):
+            cells, cell_positions = np.unique(cell_id(batch['latitude'], batch['longitude'], cell_size), return_inverse=True)
+            years, year_positions = np.unique(batch['year'], return_inverse=True)
+            keys = (cell_positions * len(years) + year_positions) * DAYS_IN_YEAR + batch['day']
+            size = len(cells) * len(years) * DAYS_IN_YEAR
+            totals = np.empty((size, 5))
+            totals[:, CHANGE] = np.bincount(keys, weights=batch['change'], minlength=size)
+            totals[:, LATITUDE] = np.bincount(keys, weights=batch['latitude'], minlength=size)
+            totals[:, LONGITUDE] = np.bincount(keys, weights=batch['longitude'], minlength=size)
+            totals[:, ELEVATION] = np.bincount(keys, weights=batch['elevation'], minlength=size)
+            totals[:, COUNT] = np.bincount(keys, minlength=size)
+
+            pairs = itertools.product(cells.tolist(), years.tolist())
+            for pair, totals_for_pair in zip(pairs, totals.reshape(-1, DAYS_IN_YEAR, 5)):
+                if not totals_for_pair[:, COUNT].any():
+                    continue  # a cell and a year that only occur in different observations
+                if pair in pair_totals:
+                    pair_totals[pair] += totals_for_pair
                 else:
-                    total_change = 0
-                    total_latitude = cur_latitude
-                    total_longitude = cur_longitude
-                    total_elevation = cur_elevation
-                    count = 1
-                
-                # update the daily average temperature change for the current date
-                daily_averages[date_key] = (total_change, total_latitude, total_longitude, total_elevation, count)
-        
-        # after processing the first CSV file
-        # break
-    
-# create the output directory if it doesn't exist
-output_dir = "averages"
-if not os.path.exists(output_dir):
-    os.mkdir(output_dir)
+                    pair_totals[pair] = totals_for_pair
+
+    cells = sorted({cell for cell, year in pair_totals})
+    years = sorted({year for cell, year in pair_totals})
+    cell_positions = {cell: position for position, cell in enumerate(cells)}
+    year_positions = {year: position for position, year in enumerate(years)}
+    totals = np.zeros((len(cells), len(years), DAYS_IN_YEAR, 5))
+    for (cell, year), totals_for_pair in pair_totals.items():
+        totals[cell_positions[cell], year_positions[year]] = totals_for_pair
+    return StationPartial(np.array(cells, dtype=np.int64), np.array(years, dtype=np.int64), totals)
+
+# reduce a single station file into a partial aggregate table per grid cell and day of the year
+def reduce_station_file(csv_file_path, cell_size=DEFAULT_CELL_SIZE, chunk_rows=STATION_CHUNK_ROWS):
+    count('station_files')
+    with timed('ingest_file'):
+        chunks = read_station_chunks(csv_file_path, chunk_rows)
+        days = reduce_days(filter_observations(parse_observations(chunks)))
+        partial = aggregate_observations(daily_changes(days), cell_size)
+        return partial._replace(station=station_id(csv_file_path), edges=day_edges(days))
+
+# reduce a station file in a worker process, handing the metrics it recorded back to the parent
+def reduce_in_worker(csv_file_path, cell_size=DEFAULT_CELL_SIZE, chunk_rows=STATION_CHUNK_ROWS):
+    partial = reduce_station_file(csv_file_path, cell_size, chunk_rows)
+    return partial, instrumentation.drain()
+
+# running totals merged from station file partials: for every day of the year, per grid cell and per year
+class StationTotals:
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.daily = np.zeros((DAYS_IN_YEAR, 5))
+        self.regional = {}
+        self.yearly = {}
+        self.edges = {}  # station -> edges of each of its files
+
+    def add(self, partial):
+        self.daily += partial.totals.sum(axis=(0, 1))
+        add_totals(self.regional, partial.cells, partial.totals.sum(axis=1))
+        add_totals(self.yearly, partial.years, partial.totals.sum(axis=0))
+        if partial.station is not None and len(partial.edges):
+            self.edges.setdefault(partial.station, []).append(partial.edges)
+
+    # add the change into the first day of each station file from the last day of the station's
+    # file before it, where the two days are consecutive (e.g. Dec 31 and Jan 1 in two year folders).
+    # Stations and their files are taken in sorted order, so the order they were added in does not matter.
+    def add_station_boundaries(self):
+        rows = []
+        for station in sorted(self.edges):
+            files = sorted(self.edges[station], key=lambda edges: tuple(edges[:, 0]))
+            for previous, following in zip(files, files[1:]):
+                if following[0, 0] == previous[1, 0] + 1:
+                    rows.append(np.concatenate([following[0, :2] - [0, previous[1, 1]], following[0, 2:]]))
+        self.edges = {}
+        if not rows:
+            return
+
+        rows = np.array(rows)
+        years, day_indices = calendar_days(rows[:, 0].astype(np.int64).astype('datetime64[D]'))
+        boundaries = {'year': years, 'day': day_indices, 'change': rows[:, 1],
+                      'latitude': rows[:, 2], 'longitude': rows[:, 3], 'elevation': rows[:, 4]}
+        self.add(aggregate_observations([boundaries], self.cell_size))
+
+# add (366, 5) daily totals into {key: totals}
+def add_totals(totals_by_key, keys, daily_totals):
+    for key, totals in zip(keys.tolist(), daily_totals):
+        if key in totals_by_key:
+            totals_by_key[key] += totals
+        else:
+            totals_by_key[key] = totals.copy()
+
+# reduce station files (in parallel when workers > 1), yielding (path, partial) in file order
+def reduce_station_files(station_files, workers=DEFAULT_WORKERS, cell_size=DEFAULT_CELL_SIZE, chunk_rows=STATION_CHUNK_ROWS):
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers > 1 and len(station_files) > 1:
+        chunksize = max(1, len(station_files) // (workers * 4))
+        reduce = bind(reduce_in_worker, cell_size=cell_size, chunk_rows=chunk_rows)
+        with ProcessPoolExecutor(max_workers=workers, initializer=instrumentation.start_worker,
+                                 initargs=(instrumentation.ENABLED,)) as executor:
+            results = executor.map(reduce, station_files, chunksize=chunksize)
+            for csv_file_path, (partial, metrics) in zip(station_files, results):
+                instrumentation.merge(metrics)
+                yield csv_file_path, partial
+    else:
+        for csv_file_path in station_files:
+            yield csv_file_path, reduce_station_file(csv_file_path, cell_size, chunk_rows)
+
+# size and modification time of a station file, used to detect changes between runs
+def file_signature(csv_file_path):
+    stat = os.stat(csv_file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+# open (creating if needed) the partial-state store
+# partials saved by an older version or for another cell size are discarded
+def open_state_store(state_path, cell_size=DEFAULT_CELL_SIZE):
+    store = sqlite3.connect(state_path)
+    store.execute("PRAGMA journal_mode=WAL")
+    store.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value REAL NOT NULL)")
+    version = store.execute("PRAGMA user_version").fetchone()[0]
+    stored_cell_size = store.execute("SELECT value FROM settings WHERE name = 'cell_size'").fetchone()
+    if version != STATE_VERSION or stored_cell_size is None or stored_cell_size[0] != cell_size:
+        store.execute("DROP TABLE IF EXISTS station_files")
+        store.execute("INSERT OR REPLACE INTO settings VALUES ('cell_size', ?)", (cell_size,))
+        store.execute(f"PRAGMA user_version = {STATE_VERSION}")
+    store.execute("CREATE TABLE IF NOT EXISTS station_files ("
+                  "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, "
+                  "cells BLOB NOT NULL, years BLOB NOT NULL, keys BLOB NOT NULL, totals BLOB NOT NULL, "
+                  "station TEXT NOT NULL, edges BLOB NOT NULL)")
+    store.commit()
+    return store
+
+# save one station file's partial, committing right away so an interrupted run can resume
+# only (cell, year, day) rows with observations are stored
+def save_partial(store, csv_file_path, signature, partial):
+    totals = partial.totals.reshape(-1, 5)
+    keys = np.flatnonzero(totals[:, COUNT]).astype(np.int32)
+    store.execute("INSERT OR REPLACE INTO station_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                  (csv_file_path, *signature, partial.cells.astype(np.int64).tobytes(), partial.years.astype(np.int64).tobytes(),
+                   keys.tobytes(), totals[keys].tobytes(), partial.station, partial.edges.tobytes()))
+    store.commit()
+
+# rebuild a partial from the rows saved by save_partial
+def load_partial(cells_blob, years_blob, keys_blob, totals_blob, station, edges_blob):
+    cells = np.frombuffer(cells_blob, dtype=np.int64)
+    years = np.frombuffer(years_blob, dtype=np.int64)
+    totals = np.zeros((len(cells) * len(years) * DAYS_IN_YEAR, 5))
+    totals[np.frombuffer(keys_blob, dtype=np.int32)] = np.frombuffer(totals_blob).reshape(-1, 5)
+    return StationPartial(cells, years, totals.reshape(len(cells), len(years), DAYS_IN_YEAR, 5),
+                          station, np.frombuffer(edges_blob).reshape(-1, 5))
+
+# reduce every station file and merge the results into StationTotals
+# partials are always merged in path order, so the output does not depend on the worker count
+# or the order the files are listed in
+# with a state store, only files that are new or changed since the last run are reduced
+def collect_totals(weather_db_path, workers=DEFAULT_WORKERS, state_path=None, cell_size=DEFAULT_CELL_SIZE,
+                  chunk_rows=STATION_CHUNK_ROWS):
+    station_files = find_station_files(weather_db_path)
+    totals = StationTotals(cell_size)
+
+    if state_path is None:
+        for csv_file_path, partial in reduce_station_files(station_files, workers, cell_size, chunk_rows):
+            logger.debug("Processed CSV file: %s", csv_file_path)
+            totals.add(partial)
+        totals.add_station_boundaries()
+        return totals
+
+    store = open_state_store(state_path, cell_size)
+    try:
+        signatures = {csv_file_path: file_signature(csv_file_path) for csv_file_path in station_files}
+        stored = {path: (size, mtime_ns) for path, size, mtime_ns in store.execute("SELECT path, size, mtime_ns FROM station_files")}
+
+        # forget station files that have been removed from the database
+        removed = [(path,) for path in stored if path not in signatures]
+        store.executemany("DELETE FROM station_files WHERE path = ?", removed)
+        store.commit()
+
+        pending = [csv_file_path for csv_file_path in station_files if stored.get(csv_file_path) != signatures[csv_file_path]]
+        logger.info("Reducing %d new or changed of %d station files", len(pending), len(station_files))
+        for csv_file_path, partial in reduce_station_files(pending, workers, cell_size, chunk_rows):
+            logger.debug("Processed CSV file: %s", csv_file_path)
+            save_partial(store, csv_file_path, signatures[csv_file_path], partial)
+
+        for blobs in store.execute("SELECT cells, years, keys, totals, station, edges FROM station_files ORDER BY path"):
+            totals.add(load_partial(*blobs))
+        totals.add_station_boundaries()
+    finally:
+        store.close()
+
+    return totals
 
 # write the daily average temperature changes to a new CSV file
-output_filename = "average.csv";
-output_filepath = os.path.join(output_dir, output_filename)
-
-with open(output_filepath, 'w', newline='') as csvfile:
-    csvwriter = csv.writer(csvfile)
-    csvwriter.writerow(["Month-Day", "Average Temperature Change", "Midpoint Latitude", "Midpoint Longitude", "Avg Elevation", "Count"])
-    for date_ky, (total_change, laditude, longitude, elevation, count) in sorted(daily_averages.items()):
-        avg_tmp_change = float(total_change) / count
-        avg_latitude = laditude / count
-        avg_longitude = longitude / count
-        avg_elevation = elevation / count
-        csvwriter.writerow([date_ky, avg_tmp_change, avg_latitude, avg_longitude, avg_elevation, count])
+def write_averages(daily_averages, output_filepath):
+    with open(output_filepath, 'w', newline='') as csvfile:
+        csvwriter = csv.writer(csvfile)
+        csvwriter.writerow(["Month-Day", "Average Temperature Change", "Midpoint Latitude", "Midpoint Longitude", "Avg Elevation", "Count"])
+        rows = sorted((DAY_KEYS[index], totals) for index, totals in enumerate(daily_averages) if totals[COUNT] > 0)
+        for date_ky, (total_change, laditude, longitude, elevation, count) in rows:
+            count = int(count)
+            avg_tmp_change = float(total_change) / count
+            avg_latitude = laditude / count
+            avg_longitude = longitude / count
+            avg_elevation = elevation / count
+            csvwriter.writerow([date_ky, avg_tmp_change, avg_latitude, avg_longitude, avg_elevation, count])
+
+# write average.csv and the global, regional and per-year climatology files into output_dir
+def write_outputs(totals, output_dir):
+    write_averages(totals.daily, os.path.join(output_dir, OUTPUT_FILENAME))
+    write_climatology(build_climatology(totals.daily), os.path.join(output_dir, CLIMATOLOGY_FILENAME))
+    write_regional_climatology(*build_regional_climatology(totals.regional),
+                               os.path.join(output_dir, REGIONAL_FILENAME), os.path.join(output_dir, REGIONAL_CELLS_FILENAME))
+    write_yearly_totals(build_yearly_totals(totals.yearly), os.path.join(output_dir, YEARLY_FILENAME))
+
+def main():
+    parser = argparse.ArgumentParser(description="Average NCEI station data into daily temperature changes.")
+    parser.add_argument('--database', default=WEATHER_DB_PATH, help="folder containing one sub-folder of station CSV files per year")
+    parser.add_argument('--output-dir', default=OUTPUT_DIR, help="folder to write average.csv into")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="number of worker processes (default: one per core, 1 = serial)")
+    parser.add_argument('--state', help=f"partial-state store (default: <output-dir>/{STATE_FILENAME})")
+    parser.add_argument('--full', action='store_true', help="discard stored partials and reduce every station file again")
+    parser.add_argument('--cell-size', type=float, default=DEFAULT_CELL_SIZE, help="size in degrees of the regional climatology grid cells")
+    parser.add_argument('--chunk-rows', type=int, default=STATION_CHUNK_ROWS, help="rows read from a station file at a time")
+    parser.add_argument('--metrics', help="time each ingest stage and write the results to this file (JSON, or Prometheus text for .prom)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log every station file as it is reduced")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
+
+    # create the output directory if it doesn't exist
+    if not os.path.exists(args.output_dir):
+        os.mkdir(args.output_dir)
+
+    state_path = args.state or os.path.join(args.output_dir, STATE_FILENAME)
+    if args.full:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(state_path + suffix):
+                os.remove(state_path + suffix)
+
+    if args.metrics:
+        instrumentation.set_enabled()
+
+    with instrumentation.profiled('ingest'):
+        totals = collect_totals(args.database, args.workers, state_path, args.cell_size, args.chunk_rows)
+    write_outputs(totals, args.output_dir)
+
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            if args.metrics.endswith('.prom'):
+                f.write(instrumentation.prometheus_text())
+            else:
+                json.dump(instrumentation.snapshot(), f, indent=2)
+
+if __name__ == '__main__':
+    main()
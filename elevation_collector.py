@@ -1,5 +1,13 @@
 import csv
+import os
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
 
 #################################################################################
 # 
@@ -14,7 +22,13 @@ import requests
 #   zip codes in the file 'zip_codes.csv' in the parent directory and
 #   places them in a file 'elevations.csv'
 #
-#   Requests were throttled by the API, so results may have been incomplete.
+#   Batches are fetched by a pool of worker threads sharing one HTTP
+#   connection pool, throttled by a token bucket and retried with
+#   backoff. Results are appended to 'elevations.csv' as they arrive,
+#   and only the coordinates that are not in it yet are fetched, so the
+#   file itself is the checkpoint: an interrupted run resumes where it
+#   stopped, and zip codes added to 'zip_codes.csv' are fetched on the
+#   next run.
 #  
 #   Acknowledgements:
 #   This script uses data from the GeoNames public API (http://www.geonames.org).
@@ -24,58 +38,184 @@ import requests
 #
 #################################################################################
 
-# define the input data as a list coordinates
-input_data = []
+# Files
+ZIP_CODE_FILE = 'zip_codes.csv'
+ELEVATION_FILE = 'elevations.csv'
+
+# GeoNames API
+API_URL = 'http://api.geonames.org/srtm1'
+API_USERNAME = 'kkode'
+HOURLY_LIMIT_MESSAGE = 'the hourly limit of 1000 credits'
+
+# Fetch settings
+BATCH_SIZE = 20  # coordinates per request
+DEFAULT_WORKERS = 4
+DEFAULT_RATE = 1000 / 3600  # requests per second (the free hourly limit)
+DEFAULT_BURST = 5  # requests that may be sent back to back
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 2  # first retry delay, doubled on every retry
+HOURLY_LIMIT_WAIT = 600  # seconds to wait after hitting the hourly limit
+REQUEST_TIMEOUT = 30
+
+class HourlyLimitExceeded(Exception):
+    pass
+
+# Token bucket shared by every worker: holds up to `capacity` tokens, refilled at `rate` per second
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-with open('zip_codes.csv', 'r') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        # extract the ZIP code, latitude, and longitude values from the row
-        zipcode = row['ZIP']
-        latitude = row['LAT']
-        longitude = row['LNG']
-        input_data.append(f'{latitude},{longitude}')
+    # block until a token is available, then take it
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
-# divide the input data into batches of 20 coordinates
-batch_size = 20
-input_batches = [input_data[i:i+batch_size] for i in range(0, len(input_data), batch_size)]
+# read the coordinates of every zip code, as 'latitude,longitude' strings
+def load_coordinates(zip_code_file):
+    input_data = []
+    with open(zip_code_file, 'r') as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            # extract the latitude and longitude values from the row
+            latitude = row['LAT']
+            longitude = row['LNG']
+            input_data.append(f'{latitude},{longitude}')
+    return input_data
 
+# the 'latitude,longitude' inputs already in the elevation file
+def load_collected_points(elevation_file):
+    if not os.path.exists(elevation_file):
+        return set()
+    with open(elevation_file, newline='') as f:
+        return {row['input'] for row in csv.DictReader(f)}
 
-input_batches = input_batches[1190:]
+# drop a row left incomplete at the end of the elevation file when a run was stopped part way through writing it
+def drop_partial_row(elevation_file):
+    if not os.path.exists(elevation_file):
+        return
+    with open(elevation_file, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
 
-# loop through each input batch and query GeoNames for elevation data
-data = []
+# HTTP session whose connection pool is large enough for every worker
+def create_session(workers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
-count = 0
-size = len(input_batches)
-for batch in input_batches:
-    print("Count: ", count, " of ", size)
+# query GeoNames for the elevations of one batch of coordinates (one line per coordinate)
+def request_batch(session, batch, api_url, username):
     latitudes = []
     longitudes = []
     for item in batch:
         lat, lng = item.split(',')
         latitudes.append(lat.strip())
         longitudes.append(lng.strip())
-    latitudes_str = ','.join(latitudes).strip()
-    longitudes_str = ','.join(longitudes).strip()
-    url = 'http://api.geonames.org/srtm1?&username=kkode&lats=' + latitudes_str.strip() + '&lngs=' + longitudes_str.strip()
-    response = requests.get(url)
-
-    if 'the hourly limit of 1000 credits' in response.text:
-        print("Hourly limit exceeded. Breaking out of loop.")
-        break   
-
-    elevation_data = response.text
-    
-    for i, item in enumerate(batch):
-        elevation_value = elevation_data.splitlines()[i]
-        data.append({'input': item, 'elevation': elevation_value})
-
-    count = count + 1
-
-# write the input and elevation data to a CSV file
-with open('elevations.csv', 'w') as f:
-    writer = csv.writer(f)
-    writer.writerow(['input', 'elevation'])
-    for row in data:
-        writer.writerow([row['input'], row['elevation']])
+    params = {'username': username, 'lats': ','.join(latitudes), 'lngs': ','.join(longitudes)}
+    response = session.get(api_url, params=params, timeout=REQUEST_TIMEOUT)
+
+    if HOURLY_LIMIT_MESSAGE in response.text:
+        raise HourlyLimitExceeded()
+    response.raise_for_status()
+
+    elevations = response.text.splitlines()
+    if len(elevations) < len(batch):
+        raise ValueError(f"expected {len(batch)} elevations, got {len(elevations)}")
+    return [elevation.strip() for elevation in elevations[:len(batch)]]
+
+# fetch one batch, waiting for the rate limiter and retrying failures with exponential backoff
+def fetch_batch(session, bucket, batch, api_url, username, max_retries=MAX_RETRIES,
+                backoff_seconds=BACKOFF_SECONDS, hourly_limit_wait=HOURLY_LIMIT_WAIT):
+    attempt = 0
+    while True:
+        bucket.acquire()
+        try:
+            return request_batch(session, batch, api_url, username)
+        except HourlyLimitExceeded:
+            # not counted as a failure: wait for the hourly credits to come back
+            print(f"Hourly limit exceeded. Waiting {hourly_limit_wait} seconds.")
+            time.sleep(hourly_limit_wait)
+        except (requests.RequestException, ValueError) as error:
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            delay = backoff_seconds * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            print(f"Request failed ({error}). Retrying in {delay:.1f} seconds.")
+            time.sleep(delay)
+
+# fetch every coordinate not yet in the elevation file, appending results to it as they arrive
+def collect_elevations(zip_code_file=ZIP_CODE_FILE, elevation_file=ELEVATION_FILE, api_url=API_URL,
+                       username=API_USERNAME, workers=DEFAULT_WORKERS, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                       hourly_limit_wait=HOURLY_LIMIT_WAIT):
+    # divide the coordinates that are not collected yet into batches of 20
+    drop_partial_row(elevation_file)
+    collected = load_collected_points(elevation_file)
+    pending = [item for item in dict.fromkeys(load_coordinates(zip_code_file)) if item not in collected]
+    input_batches = [pending[i:i+BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
+    print(f"{len(pending)} coordinates left to fetch in {len(input_batches)} batches")
+
+    write_header = not os.path.exists(elevation_file) or os.path.getsize(elevation_file) == 0
+    bucket = TokenBucket(rate, burst)
+    failed = 0
+
+    with create_session(workers) as session, \
+            open(elevation_file, 'a', newline='') as elevations, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        writer = csv.writer(elevations)
+        if write_header:
+            writer.writerow(['input', 'elevation'])
+
+        futures = {executor.submit(fetch_batch, session, bucket, batch, api_url, username,
+                                   hourly_limit_wait=hourly_limit_wait): batch
+                   for batch in input_batches}
+        for count, future in enumerate(as_completed(futures), start=1):
+            batch = futures[future]
+            try:
+                elevation_values = future.result()
+            except Exception as error:
+                failed += 1
+                print(f"Batch starting at {batch[0]} failed: {error}")
+                continue
+
+            # flushed per batch, so a stopped run keeps every batch that completed
+            for item, elevation_value in zip(batch, elevation_values):
+                writer.writerow([item, elevation_value])
+            elevations.flush()
+            print("Count: ", count, " of ", len(input_batches))
+
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Collect elevations for every zip code from the GeoNames API.")
+    parser.add_argument('--zip-codes', default=ZIP_CODE_FILE)
+    parser.add_argument('--output', default=ELEVATION_FILE)
+    parser.add_argument('--api-url', default=API_URL)
+    parser.add_argument('--username', default=API_USERNAME)
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE, help="requests per second")
+    parser.add_argument('--burst', type=int, default=DEFAULT_BURST)
+    parser.add_argument('--hourly-limit-wait', type=float, default=HOURLY_LIMIT_WAIT, help="seconds to wait after hitting the hourly limit")
+    args = parser.parse_args()
+
+    failed = collect_elevations(args.zip_codes, args.output, args.api_url, args.username,
+                                args.workers, args.rate, args.burst, args.hourly_limit_wait)
+    if failed:
+        print(f"{failed} batches failed. Run again to retry them.")
+
+if __name__ == '__main__':
+    main()
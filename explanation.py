@@ -0,0 +1,80 @@
+import os
+import sys
+
+from instrumentation import timed
+
+########################################################################
+#
+#   Project: Forecast Explanations
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Records the steps behind a prediction as (step, template, values)
+#   records. Templates are only formatted when the explanation is
+#   rendered or echoed, so an explanation nobody asked for costs
+#   nothing beyond a truth test:
+#
+#       if explain:
+#           explain.add('elevation', "Elevation: {elevation} meters", elevation=elevation)
+#
+#   The default verbosity comes from the WEATHER_VERBOSITY environment
+#   variable (0 = quiet, 1 = results only, 2 = full narrative).
+#
+########################################################################
+
+# Verbosity levels
+QUIET = 0
+SUMMARY = 1  # final predictions and chosen weather
+NARRATIVE = 2  # the full step-by-step explanation
+
+VERBOSITY = int(os.environ.get('WEATHER_VERBOSITY', QUIET))
+
+class Explanation:
+    # level: the most detailed steps to keep; echo: stream each kept step is written to as it is added
+    def __init__(self, level=NARRATIVE, echo=None):
+        self.level = level
+        self.echo = echo
+        self.records = []
+
+    # False when nothing would be recorded, so callers can skip building the values
+    def __bool__(self):
+        return self.level > QUIET
+
+    def add(self, step, template, level=NARRATIVE, **values):
+        if level > self.level:
+            return
+        self.records.append((step, template, values))
+        if self.echo is not None:
+            with timed('explanation_output'):
+                print(template.format(**values), file=self.echo)
+
+    # formatted text of every recorded step
+    def lines(self):
+        return [template.format(**values) for step, template, values in self.records]
+
+    def render(self):
+        return '\n'.join(self.lines())
+
+    # structured records, e.g. for JSON responses
+    def to_list(self):
+        return [{'step': step, 'text': template.format(**values)} for step, template, values in self.records]
+
+# Shared disabled explanation: records nothing
+NO_EXPLANATION = Explanation(QUIET)
+
+# Explanation that prints each step to the console, like the original scripts did
+def console_explanation(level=NARRATIVE):
+    return Explanation(level, echo=sys.stdout)
+
+# Explanation used when a caller does not pass one, following the global verbosity
+def default_explanation():
+    if VERBOSITY <= QUIET:
+        return NO_EXPLANATION
+    return console_explanation(VERBOSITY)
+
+def set_verbosity(level):
+    global VERBOSITY
+    VERBOSITY = level
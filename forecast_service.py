@@ -0,0 +1,214 @@
+import sys
+import json
+import math
+import time
+import argparse
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+
+import weather
+import instrumentation
+from explanation import Explanation, NARRATIVE
+
+########################################################################
+#
+#   Project: Headless Forecast Service
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Runs the forecasts from weather.py without the GUI, either once
+#   from the command line or as a local HTTP/JSON server:
+#
+#       python forecast_service.py forecast --zip 55455 --temp 20
+#       python forecast_service.py serve --port 8080
+#       GET /forecast?zip=55455&temp=20&state=Clear&date=2024-05-14&explain=1
+#
+#   The climatology, zip code and elevation data are loaded once at
+#   startup and shared by every request. With --metrics (or
+#   WEATHER_METRICS=1) the stage timings are served at /metrics in the
+#   Prometheus text format, or as JSON with /metrics?format=json.
+#
+########################################################################
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+DEFAULT_DAYS = 6
+MAX_DAYS = 366
+
+# Load every data file up front so the first request is as fast as the rest
+def load_models():
+    weather.load_data()
+
+# Forecast for a zip code. Raises ValueError with a user-facing message for bad input.
+# With explain=True the step-by-step explanation is included in the result.
+def forecast_for_zip(zip_code, current_temp, current_weather='Clear', current_day=None, days=DEFAULT_DAYS, explain=False):
+    if zip_code in (None, ''):
+        raise ValueError('Please enter a zip code.')
+    if current_temp in (None, ''):
+        raise ValueError('Please enter a temperature')
+    try:
+        current_temp = float(current_temp)
+    except ValueError:
+        raise ValueError('Please enter a valid temperature')
+    # 'inf' and 'nan' parse as floats, but would make the response invalid JSON
+    if not math.isfinite(current_temp):
+        raise ValueError('Please enter a valid temperature')
+    if current_weather not in weather.WEATHER_CHOICES:
+        raise ValueError(f"Please select a weather state from {', '.join(weather.WEATHER_CHOICES)}")
+    if current_day in (None, ''):
+        current_day = datetime.now().strftime('%Y-%m-%d')
+    try:
+        datetime.strptime(current_day, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError('Please select a date (YYYY-MM-DD)')
+    try:
+        days = int(days)
+    except (TypeError, ValueError):
+        raise ValueError(f'Please request between 1 and {MAX_DAYS} days')
+    if not 1 <= days <= MAX_DAYS:
+        raise ValueError(f'Please request between 1 and {MAX_DAYS} days')
+
+    latitude, longitude = weather.get_coordinates(zip_code)
+    if latitude == 'Invalid Zip':
+        raise ValueError('Please enter a valid zip code.')
+
+    explanation = Explanation(NARRATIVE) if explain else None
+    with instrumentation.profiled('forecast'):
+        rows = weather.forecast(latitude, longitude, current_temp, current_day, current_weather, days, explanation)
+    result = {
+        'zip': zip_code,
+        'latitude': float(latitude),
+        'longitude': float(longitude),
+        'forecast': [
+            {'date': date, 'temperature': None if math.isnan(temperature) else round(temperature, 2), 'weather': state}
+            for date, temperature, state in rows
+        ],
+    }
+    if explanation is not None:
+        result['explanation'] = explanation.to_list()
+    return result
+
+# The HTTP request handler; http.server is only imported when serving, to keep the CLI quick to start
+def make_handler():
+    from http.server import BaseHTTPRequestHandler
+
+    class ForecastHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = time.perf_counter()
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+            if url.path == '/health':
+                self.send_json(200, {'status': 'ok', 'cache': weather.forecast_cache_stats()}, start)
+            elif url.path == '/metrics':
+                if query.get('format') == 'json':
+                    self.send_json(200, instrumentation.snapshot(), start)
+                else:
+                    self.send_body(200, instrumentation.prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4', start)
+            elif url.path == '/forecast':
+                try:
+                    result = forecast_for_zip(query.get('zip'), query.get('temp'), query.get('state', 'Clear'),
+                                              query.get('date'), query.get('days', DEFAULT_DAYS),
+                                              query.get('explain', '0').lower() in ('1', 'true', 'yes'))
+                except ValueError as error:
+                    self.send_json(400, {'error': str(error)}, start)
+                else:
+                    self.send_json(200, result, start)
+            else:
+                self.send_json(404, {'error': 'Not found'}, start)
+
+        def send_json(self, status, payload, start):
+            self.send_body(status, json.dumps(payload).encode('utf-8'), 'application/json', start)
+
+        def send_body(self, status, body, content_type, start):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Forecast-Time-Ms', f'{(time.perf_counter() - start) * 1000:.3f}')
+            self.end_headers()
+            self.wfile.write(body)
+
+    return ForecastHandler
+
+# Serve forecasts over HTTP until interrupted, one thread per request
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    from http.server import ThreadingHTTPServer
+
+    load_models()
+    server = ThreadingHTTPServer((host, port), make_handler())
+    print(f"Serving forecasts on http://{host}:{server.server_port}/forecast")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# argparse types for the climatology options
+def window_years(value):
+    window = int(value)
+    if window < 1:
+        raise argparse.ArgumentTypeError("must be at least 1")
+    return window
+
+def half_life_years(value):
+    half_life = float(value)
+    if not half_life > 0:
+        raise argparse.ArgumentTypeError("must be a positive number of years")
+    return half_life
+
+# Options choosing which years the climatology is averaged over
+def add_climatology_arguments(parser):
+    parser.add_argument('--window-years', type=window_years, help="only use the last N years of station data")
+    parser.add_argument('--half-life', type=half_life_years, help="weight each year by 0.5 ** (age / half-life years)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless weather forecasts.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    forecast_command = commands.add_parser('forecast', help="print a forecast as JSON")
+    forecast_command.add_argument('--zip', required=True)
+    forecast_command.add_argument('--temp', required=True, help="current temperature in °C")
+    forecast_command.add_argument('--state', default='Clear', choices=weather.WEATHER_CHOICES)
+    forecast_command.add_argument('--date', help="current day as YYYY-MM-DD (default: today)")
+    forecast_command.add_argument('--days', type=int, default=DEFAULT_DAYS)
+    forecast_command.add_argument('--explain', action='store_true', help="print the step-by-step explanation to stderr")
+    forecast_command.add_argument('--metrics', action='store_true', help="print the stage timings to stderr as JSON")
+    add_climatology_arguments(forecast_command)
+
+    serve_command = commands.add_parser('serve', help="serve forecasts over HTTP")
+    serve_command.add_argument('--host', default=DEFAULT_HOST)
+    serve_command.add_argument('--port', type=int, default=DEFAULT_PORT)
+    serve_command.add_argument('--metrics', action='store_true', help="time each stage and serve the results at /metrics")
+    add_climatology_arguments(serve_command)
+
+    args = parser.parse_args()
+    if args.metrics:
+        instrumentation.set_enabled()
+    if args.window_years is not None or args.half_life is not None:
+        # build the climatology now, so a missing yearly.npy or an empty window fails before any forecast
+        try:
+            weather.use_climatology(args.window_years, args.half_life)
+            weather.get_climatology()
+        except (ValueError, OSError) as error:
+            parser.error(str(error))
+
+    if args.command == 'forecast':
+        try:
+            result = forecast_for_zip(args.zip, args.temp, args.state, args.date, args.days, args.explain)
+        except ValueError as error:
+            parser.error(str(error))
+        # keep the explanation out of the JSON on stdout
+        for step in result.pop('explanation', []):
+            print(step['text'], file=sys.stderr)
+        if args.metrics:
+            print(json.dumps(instrumentation.snapshot(), indent=2), file=sys.stderr)
+        print(json.dumps(result, indent=2))
+    else:
+        serve(args.host, args.port)
+
+if __name__ == '__main__':
+    main()
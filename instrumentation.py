@@ -0,0 +1,238 @@
+import os
+import time
+import bisect
+import itertools
+import threading
+from contextlib import contextmanager
+
+########################################################################
+#
+#   Project: Instrumentation
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Opt-in timing of the stages of the forecast and ingest paths:
+#
+#       with timed('elevation'):
+#           elevation = ...
+#
+#   Each stage's times are kept in a histogram, next to simple event
+#   counters, and can be exported as a JSON snapshot or in the
+#   Prometheus text format. Timing is off unless WEATHER_METRICS=1 is
+#   set (or set_enabled(True) is called); when off, timed() hands back
+#   a shared do-nothing context.
+#
+#   WEATHER_PROFILE=cprofile, =tracemalloc or =cprofile,tracemalloc
+#   also captures a profile of every request wrapped in profiled().
+#   The results are written to WEATHER_PROFILE_DIR (default 'profiles')
+#   as <name>-<time>-<n>.prof (load with pstats or snakeviz) and
+#   <name>-<time>-<n>.memory.txt.
+#
+########################################################################
+
+ENABLED = os.environ.get('WEATHER_METRICS', '0').lower() not in ('', '0', 'false', 'no')
+
+PROFILE_MODES = {mode.strip() for mode in os.environ.get('WEATHER_PROFILE', '').lower().split(',') if mode.strip()}
+PROFILE_DIR = os.environ.get('WEATHER_PROFILE_DIR', 'profiles')
+TRACEMALLOC_TOP = 25  # allocation sites listed in each memory profile
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0)
+
+# Prometheus metric names
+PROMETHEUS_PREFIX = 'weather'
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last bucket holds everything above the largest bound
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    # cumulative counts per upper bound, as Prometheus expects them
+    def cumulative(self):
+        return list(itertools.accumulate(self.counts))
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.timers:
+                self.timers[stage] = Histogram()
+            self.timers[stage].observe(seconds)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    # JSON-serializable copy of every counter and timer
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {
+                    stage: {
+                        'count': histogram.count,
+                        'total_seconds': histogram.total,
+                        'mean_seconds': histogram.total / histogram.count,
+                        'buckets': dict(zip([str(bound) for bound in histogram.buckets] + ['+Inf'], histogram.cumulative())),
+                    }
+                    for stage, histogram in sorted(self.timers.items())
+                },
+            }
+
+    # add a snapshot taken elsewhere (e.g. in a worker process) into these metrics
+    def merge(self, snapshot):
+        with self.lock:
+            for name, amount in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            for stage, timer in snapshot['timers'].items():
+                if stage not in self.timers:
+                    self.timers[stage] = Histogram()
+                histogram = self.timers[stage]
+                cumulative = list(timer['buckets'].values())
+                for index, (above, below) in enumerate(zip(cumulative, [0] + cumulative)):
+                    histogram.counts[index] += above - below
+                histogram.count += timer['count']
+                histogram.total += timer['total_seconds']
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = []
+        if snapshot['timers']:
+            name = f'{PROMETHEUS_PREFIX}_stage_seconds'
+            lines.append(f'# HELP {name} Time spent in each stage of the forecast and ingest paths.')
+            lines.append(f'# TYPE {name} histogram')
+            for stage, timer in snapshot['timers'].items():
+                for bound, cumulative_count in timer['buckets'].items():
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative_count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {timer["total_seconds"]}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {timer["count"]}')
+        if snapshot['counters']:
+            name = f'{PROMETHEUS_PREFIX}_events_total'
+            lines.append(f'# HELP {name} Number of forecasts, predictions, station files and rows processed.')
+            lines.append(f'# TYPE {name} counter')
+            for event, amount in sorted(snapshot['counters'].items()):
+                lines.append(f'{name}{{event="{event}"}} {amount}')
+        return '\n'.join(lines) + '\n'
+
+# Process-wide metrics
+METRICS = Metrics()
+
+class StageTimer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        METRICS.observe(self.stage, time.perf_counter() - self.start)
+
+class NoTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NO_TIMER = NoTimer()
+
+# Context manager timing a stage, when instrumentation is enabled
+def timed(stage):
+    if not ENABLED:
+        return NO_TIMER
+    return StageTimer(stage)
+
+def count(name, amount=1):
+    if ENABLED:
+        METRICS.count(name, amount)
+
+def set_enabled(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+def snapshot():
+    return METRICS.snapshot()
+
+def prometheus_text():
+    return METRICS.prometheus_text()
+
+def merge(metrics_snapshot):
+    if metrics_snapshot is not None:
+        METRICS.merge(metrics_snapshot)
+
+def reset():
+    METRICS.reset()
+
+# Set up a worker process: follow the parent's setting and drop any metrics copied from it
+def start_worker(enabled):
+    set_enabled(enabled)
+    reset()
+
+# Snapshot of the metrics recorded so far, then reset them (None when disabled).
+# Used by worker processes to hand their metrics back with each result.
+def drain():
+    if not ENABLED:
+        return None
+    metrics_snapshot = METRICS.snapshot()
+    METRICS.reset()
+    return metrics_snapshot
+
+# One profiled request at a time: cProfile and tracemalloc are not meant to overlap
+_profile_lock = threading.Lock()
+_profile_ids = itertools.count(1)
+
+# Capture cProfile and/or tracemalloc output for the enclosed request, as set by WEATHER_PROFILE
+@contextmanager
+def profiled(name):
+    if not PROFILE_MODES:
+        yield
+        return
+
+    # only imported when profiling is switched on
+    import cProfile
+    import tracemalloc
+
+    with _profile_lock:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stem = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{next(_profile_ids)}")
+        profiler = cProfile.Profile() if 'cprofile' in PROFILE_MODES else None
+        trace_memory = 'tracemalloc' in PROFILE_MODES
+        if trace_memory:
+            tracemalloc.start()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(stem + '.prof')
+            if trace_memory:
+                memory = tracemalloc.take_snapshot()
+                current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                with open(stem + '.memory.txt', 'w') as f:
+                    f.write(f"current: {current} bytes\npeak: {peak} bytes\n\n")
+                    for statistic in memory.statistics('lineno')[:TRACEMALLOC_TOP]:
+                        f.write(f"{statistic}\n")
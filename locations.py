@@ -0,0 +1,272 @@
+import csv
+
+import numpy as np
+
+########################################################################
+#
+#   Project: Location Index
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Loads zip_codes.csv and elevations.csv once into dictionaries so
+#   that zip code and elevation lookups are constant time instead of
+#   a scan over every row of the CSV files. Points that are not in
+#   elevations.csv are answered from a spatial grid index by
+#   interpolating the elevations of their nearest neighbours; points
+#   with no neighbour within INTERPOLATION_MAX_KM have no elevation.
+#
+########################################################################
+
+# Coordinates are rounded to this many decimal places when used as dictionary keys
+COORDINATE_PRECISION = 6
+
+# Radius of the earth in kilometers
+EARTH_RADIUS_KM = 6371
+
+# GeoNames returns this elevation for points without SRTM data (e.g. over water)
+SRTM_NO_DATA = -32768
+
+# Defaults for inverse-distance-weighted elevation interpolation
+INTERPOLATION_NEIGHBOURS = 4
+INTERPOLATION_POWER = 2
+INTERPOLATION_MAX_KM = 100  # neighbours further away than this are not used
+
+# Size in degrees of a spatial index grid cell
+GRID_CELL_SIZE = 0.5
+
+# normalize a latitude/longitude pair (strings or numbers) into a dictionary key
+def coordinate_key(lat, lon):
+    return round(float(lat), COORDINATE_PRECISION), round(float(lon), COORDINATE_PRECISION)
+
+# great-circle distance in km between points (scalars or arrays) using the Haversine formula
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+# Grid index over a set of points, answering nearest-k and interpolation queries.
+# Points are bucketed into cells of cell_size degrees and sorted by cell id, so each
+# query only looks at the cells in a growing square around the query point.
+class SpatialIndex:
+    def __init__(self, latitudes, longitudes, values, cell_size=GRID_CELL_SIZE):
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.cell_size = cell_size
+        self.lat_cells = int(np.ceil(180 / cell_size))
+        self.lon_cells = int(np.ceil(360 / cell_size))
+
+        rows, cols = self._cell(self.latitudes, self.longitudes)
+        cell_ids = rows * self.lon_cells + cols
+        self.order = np.argsort(cell_ids, kind='stable')
+        self.cell_ids = cell_ids[self.order]
+
+    def __len__(self):
+        return len(self.values)
+
+    # grid row and column of points (longitude wraps around)
+    def _cell(self, lat, lon):
+        rows = np.clip(np.floor((np.asarray(lat) + 90) / self.cell_size).astype(int), 0, self.lat_cells - 1)
+        cols = np.floor((np.asarray(lon) + 180) / self.cell_size).astype(int) % self.lon_cells
+        return rows, cols
+
+    # ids of every cell in the square of the given radius (in cells) around a cell
+    def _square(self, row, col, radius):
+        rows = np.arange(max(row - radius, 0), min(row + radius, self.lat_cells - 1) + 1)
+        cols = np.unique(np.arange(col - radius, col + radius + 1) % self.lon_cells)
+        return (rows[:, None] * self.lon_cells + cols[None, :]).ravel()
+
+    # indices of the points in the given cells
+    def _points_in(self, cell_ids):
+        starts = np.searchsorted(self.cell_ids, cell_ids, side='left')
+        stops = np.searchsorted(self.cell_ids, cell_ids, side='right')
+        if not np.any(stops > starts):
+            return np.empty(0, dtype=int)
+        return self.order[np.concatenate([np.arange(start, stop) for start, stop in zip(starts, stops) if stop > start])]
+
+    # indices and distances (km) of the k points nearest to (lat, lon), closest first
+    def nearest(self, lat, lon, k=1):
+        indices, distances = self.nearest_batch([lat], [lon], k)
+        return indices[0], distances[0]
+
+    # nearest-k for arrays of points: (n, k) arrays of indices and distances, closest first
+    # queries in the same grid cell share their candidate points, so they are answered together
+    def nearest_batch(self, lats, lons, k=1):
+        lats = np.asarray(lats, dtype=float).ravel()
+        lons = np.asarray(lons, dtype=float).ravel()
+        k = min(k, len(self))
+        indices = np.empty((len(lats), k), dtype=int)
+        distances = np.empty((len(lats), k))
+        if k == 0 or len(lats) == 0:
+            return indices, distances
+
+        rows, cols = self._cell(lats, lons)
+        query_cells = rows * self.lon_cells + cols
+        order = np.argsort(query_cells, kind='stable')
+        group_starts = np.flatnonzero(np.diff(query_cells[order])) + 1
+        for group in np.split(order, group_starts):
+            indices[group], distances[group] = self._nearest_group(lats[group], lons[group], rows[group[0]], cols[group[0]], k)
+        return indices, distances
+
+    # nearest-k for queries that all fall in the grid cell (row, col)
+    def _nearest_group(self, lats, lons, row, col, k):
+        searched = np.empty(0, dtype=int)
+        candidates = np.empty(0, dtype=int)
+        radius = 0
+        while True:
+            # far from every point, checking all of them is cheaper than scanning more empty cells
+            if (2 * radius + 1) ** 2 > max(len(self) // 64, 9):
+                candidates = np.arange(len(self))
+                covers_grid = True
+            else:
+                square = self._square(row, col, radius)
+                candidates = np.concatenate([candidates, self._points_in(np.setdiff1d(square, searched, assume_unique=True))])
+                searched = square
+                covers_grid = len(square) == self.lat_cells * self.lon_cells
+
+            if len(candidates) >= k or covers_grid:
+                distances = haversine_km(lats[:, None], lons[:, None], self.latitudes[candidates], self.longitudes[candidates])
+                kth_distance = np.partition(distances, k - 1, axis=1)[:, k - 1]
+
+                # every point outside the square is at least `radius` cells away in latitude or longitude
+                edge_lat = min(float(np.max(np.abs(lats))) + radius * self.cell_size, 90)
+                bound = EARTH_RADIUS_KM * np.radians(radius * self.cell_size) * np.cos(np.radians(edge_lat))
+                if covers_grid or np.all(kth_distance <= bound):
+                    closest = np.argsort(distances, axis=1, kind='stable')[:, :k]
+                    return candidates[closest], np.take_along_axis(distances, closest, axis=1)
+            radius += 1
+
+    # inverse-distance-weighted value at arrays of points (exact where a point is in the index),
+    # from the neighbours within max_km; NaN where there are none
+    def interpolate_batch(self, lats, lons, k=INTERPOLATION_NEIGHBOURS, power=INTERPOLATION_POWER,
+                          max_km=INTERPOLATION_MAX_KM):
+        indices, distances = self.nearest_batch(lats, lons, k)
+        if indices.shape[1] == 0:
+            return np.full(len(indices), np.nan)
+        values = self.values[indices]
+        with np.errstate(divide='ignore'):
+            weights = np.where(distances <= max_km, 1 / distances ** power, 0.0)
+        exact = np.isinf(weights)
+        weights = np.where(exact.any(axis=1, keepdims=True), exact, weights)
+        total = np.sum(weights, axis=1)
+        with np.errstate(invalid='ignore'):
+            return np.where(total > 0, np.sum(weights * values, axis=1) / total, np.nan)
+
+    # inverse-distance-weighted value at a single point (NaN with no neighbour within max_km)
+    def interpolate(self, lat, lon, k=INTERPOLATION_NEIGHBOURS, power=INTERPOLATION_POWER, max_km=INTERPOLATION_MAX_KM):
+        return float(self.interpolate_batch([lat], [lon], k, power, max_km)[0])
+
+# ZIP -> (latitude, longitude), kept as the strings stored in zip_codes.csv
+def read_zip_codes(zip_code_file):
+    zip_codes = {}
+    with open(zip_code_file, newline='') as csvfile:
+        for row in csv.DictReader(csvfile):
+            zip_codes[row['ZIP']] = (row['LAT'], row['LNG'])
+    return zip_codes
+
+# (latitude, longitude) -> elevation in meters, from elevations.csv
+def read_elevations(elevation_file):
+    elevations = {}
+    with open(elevation_file, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)  # skip header row
+        for coordinates, elevation in reader:
+            try:
+                lat, lon = coordinates.split(',')
+                key = coordinate_key(lat, lon)
+                elevation = float(elevation)
+            except ValueError:
+                continue  # repeated header or malformed row
+            # keep the first elevation for a point, like the old linear scan did
+            elevations.setdefault(key, elevation)
+    return elevations
+
+class LocationIndex:
+    # zip_codes: ZIP -> (latitude, longitude) strings; elevations: coordinate_key -> meters
+    def __init__(self, zip_codes, elevations):
+        self.zip_codes = zip_codes
+        self.elevations = elevations
+        self._elevation_arrays = None
+        self._elevation_index = None
+
+    @classmethod
+    def from_files(cls, zip_code_file, elevation_file):
+        return cls(read_zip_codes(zip_code_file), read_elevations(elevation_file))
+
+    # rebuild an index from the arrays returned by to_arrays
+    @classmethod
+    def from_arrays(cls, arrays):
+        zip_codes = dict(zip(arrays['zip_codes'].tolist(),
+                             zip(arrays['zip_latitudes'].tolist(), arrays['zip_longitudes'].tolist())))
+        latitudes, longitudes, elevations = arrays['elevation_latitudes'], arrays['elevation_longitudes'], arrays['elevations']
+        index = cls(zip_codes, dict(zip(zip(latitudes.tolist(), longitudes.tolist()), elevations.tolist())))
+        index._elevation_arrays = (latitudes, longitudes, elevations)
+        return index
+
+    # the zip code and elevation tables as arrays, e.g. for a data snapshot
+    def to_arrays(self):
+        latitudes, longitudes, elevations = self.elevation_arrays()
+        zip_latitudes = [lat for lat, lon in self.zip_codes.values()]
+        zip_longitudes = [lon for lat, lon in self.zip_codes.values()]
+        return {
+            'zip_codes': np.array(list(self.zip_codes), dtype=str),
+            'zip_latitudes': np.array(zip_latitudes, dtype=str),
+            'zip_longitudes': np.array(zip_longitudes, dtype=str),
+            'elevation_latitudes': latitudes,
+            'elevation_longitudes': longitudes,
+            'elevations': elevations,
+        }
+
+    # latitudes, longitudes and elevations of every stored point, as arrays
+    def elevation_arrays(self):
+        if self._elevation_arrays is None:
+            points = list(self.elevations)
+            self._elevation_arrays = (np.array([lat for lat, lon in points], dtype=float),
+                                      np.array([lon for lat, lon in points], dtype=float),
+                                      np.array(list(self.elevations.values()), dtype=float))
+        return self._elevation_arrays
+
+    # latitude and longitude strings for a zip code, or None if it is unknown
+    def coordinates(self, zip_code):
+        return self.zip_codes.get(zip_code)
+
+    # elevation in meters for a point, or None if it is not in elevations.csv
+    # or is stored there as SRTM_NO_DATA (so it gets interpolated like any other missing point)
+    def elevation(self, lat, lon):
+        elevation = self.elevations.get(coordinate_key(lat, lon))
+        if elevation == SRTM_NO_DATA:
+            return None
+        return elevation
+
+    # spatial index over every point with a valid elevation, built on first use
+    def elevation_index(self):
+        if self._elevation_index is None:
+            latitudes, longitudes, elevations = self.elevation_arrays()
+            valid = elevations != SRTM_NO_DATA
+            self._elevation_index = SpatialIndex(latitudes[valid], longitudes[valid], elevations[valid])
+        return self._elevation_index
+
+    # elevation for any point: the stored value if there is one, otherwise interpolated from
+    # the nearest points in elevations.csv (None if there are none within INTERPOLATION_MAX_KM)
+    def interpolated_elevation(self, lat, lon, k=INTERPOLATION_NEIGHBOURS):
+        elevation = self.elevation(lat, lon)
+        if elevation is not None:
+            return elevation
+        elevation = self.elevation_index().interpolate(float(lat), float(lon), k)
+        if np.isnan(elevation):
+            return None
+        return elevation
+
+    # elevations for arrays of points, interpolating wherever there is no stored value
+    # (NaN where there is no point within INTERPOLATION_MAX_KM)
+    def interpolated_elevations(self, lats, lons, k=INTERPOLATION_NEIGHBOURS):
+        lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+        stored = [self.elevation(lat, lon) for lat, lon in zip(lats, lons)]
+        elevations = np.array([np.nan if elevation is None else elevation for elevation in stored])
+        missing = np.isnan(elevations)
+        if missing.any():
+            elevations[missing] = self.elevation_index().interpolate_batch(lats[missing], lons[missing], k)
+        return elevations
@@ -0,0 +1,102 @@
+import io
+import os
+import json
+import argparse
+
+import numpy as np
+
+from climatology import load_climatology, load_regional_climatology, RegionalClimatology
+from locations import LocationIndex
+
+########################################################################
+#
+#   Project: Data Snapshot
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Packs the zip code table, the elevation table and the climatology
+#   into one uncompressed .npz file that is loaded with a single read,
+#   so a short-lived process does not have to parse the CSV files:
+#
+#       python snapshot.py
+#
+#   The snapshot records the size and modification time of the files
+#   it was built from. If any of them has changed since, the snapshot
+#   is ignored and the files are read directly. Source files that are
+#   missing (e.g. a container that only ships the snapshot) are fine.
+#
+########################################################################
+
+SNAPSHOT_VERSION = 1  # bumped whenever the arrays in the snapshot change
+
+class Snapshot:
+    def __init__(self, location_index, climatology, regional):
+        self.location_index = location_index
+        self.climatology = climatology
+        self.regional = regional  # RegionalClimatology, or None when it was not built
+
+# size and modification time of a file, or None if it does not exist
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+# sources: {name: path} of the zip_codes, elevations, climatology, regional and regional_cells files
+def write_snapshot(path, sources):
+    location_index = LocationIndex.from_files(sources['zip_codes'], sources['elevations'])
+    arrays = location_index.to_arrays()
+    arrays['climatology'] = np.asarray(load_climatology(sources['climatology']))
+    regional = load_regional_climatology(sources['regional'], sources['regional_cells'])
+    if regional is not None:
+        arrays['regional_rows'] = np.asarray(regional.rows)
+        arrays['regional_cells'] = np.asarray(regional.cells)
+    arrays['version'] = np.array(SNAPSHOT_VERSION)
+    arrays['sources'] = np.array(json.dumps({name: file_signature(source) for name, source in sources.items()}))
+
+    # write next to the destination and rename, so a reader never sees a partial snapshot
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(temporary_path, path)
+
+# load a snapshot, or None if it is missing, from another version or older than its sources
+def load_snapshot(path, sources):
+    try:
+        with open(path, 'rb') as f:
+            contents = f.read()
+    except OSError:
+        return None
+
+    with np.load(io.BytesIO(contents)) as data:
+        if int(data['version']) != SNAPSHOT_VERSION:
+            return None
+        recorded = json.loads(str(data['sources']))
+        for name, source in sources.items():
+            signature = file_signature(source)
+            if signature is not None and signature != recorded.get(name):
+                return None
+        arrays = {name: data[name] for name in data.files}
+
+    regional = None
+    if 'regional_rows' in arrays:
+        regional = RegionalClimatology(arrays['regional_rows'], arrays['regional_cells'])
+    return Snapshot(LocationIndex.from_arrays(arrays), arrays['climatology'], regional)
+
+def main():
+    # the data file locations are the ones weather.py reads
+    import weather
+
+    parser = argparse.ArgumentParser(description="Pack the zip code, elevation and climatology data into one snapshot file.")
+    parser.add_argument('--output', default=weather.SNAPSHOT_FILE)
+    args = parser.parse_args()
+
+    write_snapshot(args.output, weather.snapshot_sources())
+    print(f"Wrote {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+from cache import LRUCache
+
+########################################################################
+#
+#   Project: Forecast Cache Tests
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Checks the eviction order and counters of the forecast cache, and
+#   that a value computed before the cache was cleared is not stored:
+#
+#       python -m pytest test_cache.py
+#
+########################################################################
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1, cache.generation)
+    cache.put('b', 2, cache.generation)
+    assert cache.lookup('a') == 1  # 'b' is now the least recently used
+    cache.put('c', 3, cache.generation)
+    assert cache.lookup('b') is None
+    assert cache.lookup('c') == 3
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'evictions': 1, 'size': 2, 'maxsize': 2}
+
+# a value computed from the data before a clear() belongs to the old data
+def test_drops_values_from_before_a_clear():
+    cache = LRUCache(2)
+    generation = cache.generation
+    assert cache.lookup('a') is None
+    cache.clear()
+    cache.put('a', 'old data', generation)
+    assert cache.lookup('a') is None
+
+    cache.put('a', 'new data', cache.generation)
+    assert cache.lookup('a') == 'new data'
@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+import pytest
+
+import data_collector
+from benchmarks import NCEI_HEADER, generate_station_files
+from climatology import COUNT, day_index
+
+########################################################################
+#
+#   Project: Data Collector Tests
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Checks that the collector output does not depend on the worker
+#   count, the chunk size, the order the station files are merged in,
+#   or the order of the rows within each file. Runs on small synthetic
+#   NCEI data:
+#
+#       python -m pytest test_data_collector.py
+#
+########################################################################
+
+YEARS = 3
+STATIONS = 5
+ROWS = 600
+SEED = 0
+
+# the same synthetic data twice, the second copy with the rows of every file shuffled
+@pytest.fixture(scope='module')
+def databases(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('weather')
+    database = str(workdir / 'weather_database')
+    shuffled_database = str(workdir / 'shuffled_database')
+    generate_station_files(database, YEARS, STATIONS, ROWS, SEED)
+    generate_station_files(shuffled_database, YEARS, STATIONS, ROWS, SEED, shuffle=True)
+    return database, shuffled_database
+
+@pytest.fixture(scope='module')
+def expected(databases):
+    totals = data_collector.collect_totals(databases[0], 1)
+    assert totals.daily[:, COUNT].sum() > 0
+    return totals
+
+# counts must match exactly, the other columns up to rounding
+def assert_same_totals(expected, actual):
+    tables = [('daily', expected.daily, actual.daily)]
+    for name in ('regional', 'yearly'):
+        expected_tables = getattr(expected, name)
+        actual_tables = getattr(actual, name)
+        assert sorted(expected_tables) == sorted(actual_tables), name
+        tables += [(f"{name}[{key}]", expected_tables[key], actual_tables[key]) for key in sorted(expected_tables)]
+
+    for name, expected_table, actual_table in tables:
+        np.testing.assert_array_equal(expected_table[:, COUNT], actual_table[:, COUNT], err_msg=name)
+        np.testing.assert_allclose(expected_table, actual_table, rtol=1e-9, atol=1e-9, err_msg=name)
+
+def test_parallel_matches_serial(databases, expected):
+    assert_same_totals(expected, data_collector.collect_totals(databases[0], 3))
+
+def test_chunked_matches_serial(databases, expected):
+    assert_same_totals(expected, data_collector.collect_totals(databases[0], 1, chunk_rows=ROWS // 7))
+
+def test_shuffled_rows_match_serial(databases, expected):
+    assert_same_totals(expected, data_collector.collect_totals(databases[1], 2))
+
+def test_reversed_file_order_matches_serial(databases, expected):
+    station_files = data_collector.find_station_files(databases[0])[::-1]
+    totals = data_collector.StationTotals()
+    for _, partial in data_collector.reduce_station_files(station_files, 1):
+        totals.add(partial)
+    totals.add_station_boundaries()
+    assert_same_totals(expected, totals)
+
+def test_state_store_matches_serial(databases, expected, tmp_path):
+    state_path = str(tmp_path / data_collector.STATE_FILENAME)
+    assert_same_totals(expected, data_collector.collect_totals(databases[0], 2, state_path))
+
+    # a rerun after one file changed only reduces that file
+    os.utime(data_collector.find_station_files(databases[0])[0], ns=(1, 1))
+    assert_same_totals(expected, data_collector.collect_totals(databases[0], 2, state_path))
+
+def station_row(date, temp, quality='1'):
+    return (f'"X","{date}","4","10.0","20.0","100.0","N","FM-12","9","V","a","b","c",'
+            f'"{temp:+05d},{quality}","d","e"\n')
+
+# daily means, gaps and the change across two files of one station
+def test_daily_changes(tmp_path):
+    for year in ('2019', '2020'):
+        os.mkdir(tmp_path / year)
+    with open(tmp_path / '2019' / 'X.csv', 'w') as f:
+        f.write(NCEI_HEADER + station_row('2019-12-31T12:00:00', 100) + station_row('2019-12-30T00:00:00', 50)
+                + station_row('2019-12-31T00:00:00', 120) + station_row('2019-12-30T06:00:00', 9999)
+                + station_row('2019-12-28T00:00:00', 0))
+    with open(tmp_path / '2020' / 'X.csv', 'w') as f:
+        f.write(NCEI_HEADER + station_row('2020-01-01T00:00:00', 130) + station_row('2020-01-02T00:00:00', 100, '3'))
+
+    daily = data_collector.collect_totals(str(tmp_path), 1).daily
+    # Dec 30 averages 5.0°C (the 9999 reading is missing) and Dec 31 11.0°C; Jan 1 is 13.0°C.
+    # Dec 28 and Dec 30 follow days without observations and Jan 2 is erroneous, so they have no change.
+    assert list(np.flatnonzero(daily[:, COUNT])) == [day_index(1, 1), day_index(12, 31)]
+    assert daily[day_index(12, 31)] == pytest.approx([6.0, 10.0, 20.0, 100.0, 1])
+    assert daily[day_index(1, 1)] == pytest.approx([2.0, 10.0, 20.0, 100.0, 1])
@@ -0,0 +1,160 @@
+import csv
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+import elevation_collector
+
+########################################################################
+#
+#   Project: Elevation Collector Tests
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Runs the elevation collector against a local stand-in for the
+#   GeoNames srtm1 API and checks that it fetches every coordinate
+#   once: after an interrupted run, after zip codes are added, and
+#   after hitting the hourly limit.
+#
+#       python -m pytest test_elevation_collector.py
+#
+########################################################################
+
+POINTS = 95  # 5 batches, the last one partial
+
+# stand-in elevation for a point, so results can be checked
+def fake_elevation(lat, lng):
+    return str(int(float(lat) * 10 + float(lng)))
+
+# GeoNames stand-in: answers one elevation per line and records the coordinates of every request.
+# While hourly_limit is above 0, requests get the hourly limit message instead (and it counts down).
+class StandInServer:
+    def __init__(self):
+        self.requests = []
+        self.hourly_limit = 0
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                with stand_in.lock:
+                    limited = stand_in.hourly_limit > 0
+                    if limited:
+                        stand_in.hourly_limit -= 1
+                        body = f"the {elevation_collector.HOURLY_LIMIT_MESSAGE} has been exceeded"
+                    else:
+                        lats, lngs = query['lats'][0].split(','), query['lngs'][0].split(',')
+                        stand_in.requests.append(list(zip(lats, lngs)))
+                        body = ''.join(fake_elevation(lat, lng) + '\r\n' for lat, lng in zip(lats, lngs))
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(body.encode())
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/srtm1'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def fetched(self):
+        return [point for request in self.requests for point in request]
+
+@pytest.fixture
+def server():
+    stand_in = StandInServer()
+    stand_in.thread.start()
+    yield stand_in
+    stand_in.server.shutdown()
+    stand_in.server.server_close()
+
+def write_zip_codes(path, rows):
+    with open(path, 'w', newline='') as f:
+        f.write('ZIP,LAT,LNG\n')
+        for zip_code, lat, lng in rows:
+            f.write(f'{zip_code},{lat}, {lng}\n')
+
+def zip_rows(count, start=0):
+    return [(f'{index:05d}', f'{30 + index / 100:.6f}', f'{-100 - index / 100:.6f}') for index in range(start, start + count)]
+
+# the elevation file as {input: elevation}, checking that no input appears twice
+def read_elevations(path):
+    with open(path, newline='') as f:
+        rows = list(csv.DictReader(f))
+    inputs = [row['input'] for row in rows]
+    assert len(inputs) == len(set(inputs))
+    return {row['input']: row['elevation'] for row in rows}
+
+def expected_elevations(rows):
+    return {f'{lat}, {lng}': fake_elevation(lat, lng) for _, lat, lng in rows}
+
+def collect(server, tmp_path, **options):
+    return elevation_collector.collect_elevations(str(tmp_path / 'zip_codes.csv'), str(tmp_path / 'elevations.csv'),
+                                                  server.url, 'test', workers=3, rate=1000, burst=100, **options)
+
+def test_collects_every_point_once(server, tmp_path):
+    rows = zip_rows(POINTS)
+    write_zip_codes(tmp_path / 'zip_codes.csv', rows)
+    assert collect(server, tmp_path) == 0
+    assert read_elevations(tmp_path / 'elevations.csv') == expected_elevations(rows)
+    assert len(server.requests) == 5
+    assert all(len(request) <= elevation_collector.BATCH_SIZE for request in server.requests)
+
+    # nothing is left to fetch on a second run
+    assert collect(server, tmp_path) == 0
+    assert len(server.requests) == 5
+
+def test_resumes_an_interrupted_run(server, tmp_path):
+    rows = zip_rows(POINTS)
+    write_zip_codes(tmp_path / 'zip_codes.csv', rows)
+    collect(server, tmp_path)
+
+    # keep the header and 29 rows, then part of the next row, as if the run had been stopped
+    with open(tmp_path / 'elevations.csv') as f:
+        lines = f.readlines()
+    with open(tmp_path / 'elevations.csv', 'w') as f:
+        f.writelines(lines[:30])
+        f.write(lines[30][:8])
+    kept = {row[0] for row in csv.reader(lines[1:30])}
+    server.requests.clear()
+
+    # batches finish in any order, so the kept rows are not necessarily the first zip codes
+    assert collect(server, tmp_path) == 0
+    assert sorted(server.fetched()) == sorted((lat, lng) for _, lat, lng in rows if f'{lat}, {lng}' not in kept)
+    assert read_elevations(tmp_path / 'elevations.csv') == expected_elevations(rows)
+
+# a zip code inserted at the top shifts every row after it, but only the new point is fetched
+def test_fetches_zip_codes_added_to_the_zip_file(server, tmp_path):
+    rows = zip_rows(POINTS)
+    write_zip_codes(tmp_path / 'zip_codes.csv', rows)
+    collect(server, tmp_path)
+    server.requests.clear()
+
+    new_rows = zip_rows(1, start=POINTS) + rows + zip_rows(2, start=POINTS + 1)
+    write_zip_codes(tmp_path / 'zip_codes.csv', new_rows)
+    assert collect(server, tmp_path) == 0
+    assert len(server.requests) == 1
+    assert sorted(server.fetched()) == sorted((lat, lng) for _, lat, lng in zip_rows(3, start=POINTS))
+    assert read_elevations(tmp_path / 'elevations.csv') == expected_elevations(new_rows)
+
+# zip codes that share coordinates are fetched and written once
+def test_fetches_shared_coordinates_once(server, tmp_path):
+    rows = zip_rows(10)
+    write_zip_codes(tmp_path / 'zip_codes.csv', rows + [('99999', rows[0][1], rows[0][2])])
+    collect(server, tmp_path)
+    assert len(server.fetched()) == 10
+    assert read_elevations(tmp_path / 'elevations.csv') == expected_elevations(rows)
+
+def test_waits_out_the_hourly_limit(server, tmp_path):
+    rows = zip_rows(POINTS)
+    write_zip_codes(tmp_path / 'zip_codes.csv', rows)
+    server.hourly_limit = 3
+    assert collect(server, tmp_path, hourly_limit_wait=0) == 0
+    assert server.hourly_limit == 0
+    assert read_elevations(tmp_path / 'elevations.csv') == expected_elevations(rows)
@@ -0,0 +1,182 @@
+import os
+
+import numpy as np
+import pytest
+
+import benchmarks
+import data_collector
+import instrumentation
+import weather
+from explanation import NO_EXPLANATION
+
+########################################################################
+#
+#   Project: Forecast Tests
+#
+#   Author: Kennedy Smith
+#   Class: CS458
+#   Email: kennedy.smith@yale.edu
+#
+#   Description:
+#   Checks the vectorized forecast paths against the scalar ones they
+#   replace, on a climatology built from small synthetic NCEI data
+#   and the real zip code and elevation tables:
+#
+#       python -m pytest test_weather.py
+#
+########################################################################
+
+YEARS = 2
+STATIONS = 40
+ROWS = 400
+SEED = 0
+SAMPLES = 200
+
+# a point that is not in elevations.csv, so its elevation is interpolated
+GPS_POINT = (40.0, -105.3)
+
+# a point with no elevation data within INTERPOLATION_MAX_KM
+REMOTE_POINT = (27.99, 86.92)
+
+# days that start and end the year, and Feb 29 (only in the leap-year rows of the climatology)
+EDGE_DAYS = ['01-01', '02-28', '02-29', '03-01', '12-30', '12-31']
+
+# point weather.py at a climatology built from synthetic station files, and the tables next to this file
+@pytest.fixture(scope='module', autouse=True)
+def synthetic_climatology(tmp_path_factory):
+    workdir = tmp_path_factory.mktemp('weather')
+    database = str(workdir / 'weather_database')
+    averages = str(workdir / 'averages')
+    os.mkdir(averages)
+    benchmarks.generate_station_files(database, YEARS, STATIONS, ROWS, SEED)
+    data_collector.write_outputs(data_collector.collect_totals(database, 1), averages)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with pytest.MonkeyPatch.context() as patch:
+        for name in ('CLIMATOLOGY_FILE', 'REGIONAL_CLIMATOLOGY_FILE', 'REGIONAL_CELLS_FILE',
+                     'YEARLY_TOTALS_FILE', 'SNAPSHOT_FILE'):
+            patch.setattr(weather, name, getattr(weather, name))
+        benchmarks.use_averages(averages)
+        patch.setattr(weather, 'ZIP_CODE_FILE', os.path.join(here, 'zip_codes.csv'))
+        patch.setattr(weather, 'ELEVATION_FILE', os.path.join(here, 'elevations.csv'))
+        for name in ('_snapshot', '_climatology', '_climatology_shift', '_regional_climatology',
+                     '_location_index', '_data_signature'):
+            patch.setattr(weather, name, None)
+        weather.clear_forecast_cache()
+        yield
+    weather.clear_forecast_cache()
+
+# sampled zip codes that can be forecast (have elevation data nearby), and GPS_POINT
+@pytest.fixture(scope='module')
+def locations():
+    coordinates = [tuple(map(float, coordinates)) for coordinates in weather.get_location_index().zip_codes.values()]
+    coordinates = [point for point in sorted(coordinates) if weather.get_elevation(*point) is not None]
+    sample = np.random.default_rng(SEED).choice(len(coordinates), SAMPLES, replace=False)
+    return np.array([coordinates[index] for index in sample] + [GPS_POINT])
+
+def scalar_predictions(latitudes, longitudes, current_temps, current_days, current_weather_states):
+    return np.array([weather.predict_temperature(latitude, longitude, current_temp, current_day, state, NO_EXPLANATION)
+                     for latitude, longitude, current_temp, current_day, state
+                     in zip(latitudes, longitudes, current_temps, current_days, current_weather_states)])
+
+def test_gps_point_is_interpolated():
+    assert weather.get_location_index().elevation(*GPS_POINT) is None
+    assert weather.get_elevation(*GPS_POINT) is not None
+
+# one (location, day, temperature, weather) per prediction
+def test_batch_matches_scalar(locations):
+    rng = np.random.default_rng(SEED)
+    days = rng.choice(EDGE_DAYS + ['05-14', '07-04', '10-31'], len(locations))
+    temps = rng.uniform(-20, 35, len(locations))
+    states = rng.choice(weather.WEATHER_CHOICES, len(locations))
+
+    batch = weather.predict_temperature_batch(locations[:, 0], locations[:, 1], temps, days, states)
+    expected = scalar_predictions(locations[:, 0], locations[:, 1], temps, days, states)
+    np.testing.assert_array_equal(batch, expected)
+
+# every location on every day, with the days as a row broadcast against a column of locations
+def test_broadcast_days_match_scalar(locations):
+    days = np.array(EDGE_DAYS)
+    latitudes, longitudes = locations[:, :1], locations[:, 1:]
+
+    batch = weather.predict_temperature_batch(latitudes, longitudes, 20.0, days[None, :], 'Rainy')
+    assert batch.shape == (len(locations), len(days))
+    grid_latitudes, grid_longitudes, grid_days = np.broadcast_arrays(latitudes, longitudes, days[None, :])
+    expected = scalar_predictions(grid_latitudes.ravel(), grid_longitudes.ravel(), np.full(batch.size, 20.0),
+                                  grid_days.ravel(), ['Rainy'] * batch.size)
+    np.testing.assert_array_equal(batch, expected.reshape(batch.shape))
+
+# day-of-year row offsets give the same predictions as the 'MM-DD' strings they stand for
+def test_day_offsets_match_day_strings(locations):
+    days = np.array(EDGE_DAYS)
+    by_string = weather.predict_temperature_batch(locations[:, :1], locations[:, 1:], 5.0, days[None, :], 'Snowy')
+    by_offset = weather.predict_temperature_batch(locations[:, :1], locations[:, 1:], 5.0,
+                                                  weather.get_day_indices(days)[None, :], 'Snowy')
+    np.testing.assert_array_equal(by_string, by_offset)
+
+# every broadcast prediction is counted, not just the entries of current_temps
+def test_batch_counts_broadcast_predictions(locations):
+    enabled = instrumentation.ENABLED
+    instrumentation.set_enabled()
+    instrumentation.reset()
+    try:
+        weather.predict_temperature_batch(locations[:, :1], locations[:, 1:], 20.0, np.array(EDGE_DAYS)[None, :], 'Clear')
+        assert instrumentation.snapshot()['counters']['predictions'] == len(locations) * len(EDGE_DAYS)
+    finally:
+        instrumentation.reset()
+        instrumentation.set_enabled(enabled)
+
+# where the scalar prediction has no elevation to work with, the batch one is NaN
+def test_remote_point_is_nan_in_batch():
+    with pytest.raises(ValueError, match='no elevation data'):
+        weather.predict_temperature(*REMOTE_POINT, 20.0, '05-14', 'Clear', NO_EXPLANATION)
+    batch = weather.predict_temperature_batch([REMOTE_POINT[0], GPS_POINT[0]], [REMOTE_POINT[1], GPS_POINT[1]],
+                                              20.0, '05-14', 'Clear')
+    assert np.isnan(batch[0]) and not np.isnan(batch[1])
+
+# next-day weather probabilities as choose_weather samples them (normalized like random.choices)
+def next_weather(current_weather, elevation, temperature):
+    probabilities = np.array(weather.weather_probabilities(current_weather, elevation, temperature)[0])
+    return probabilities / probabilities.sum()
+
+def test_ensemble_is_reproducible():
+    first = weather.forecast_weather_ensemble(*GPS_POINT, 3.0, '2024-12-29', 'Cloudy', 6, 2000, seed=1)
+    second = weather.forecast_weather_ensemble(*GPS_POINT, 3.0, '2024-12-29', 'Cloudy', 6, 2000, seed=1)
+    assert first[0] == second[0] == ['2024-12-30', '2024-12-31', '2025-01-01', '2025-01-02', '2025-01-03', '2025-01-04']
+    np.testing.assert_array_equal(first[1], second[1])
+    np.testing.assert_allclose(first[1].sum(axis=1), 1)
+
+@pytest.mark.parametrize('current_weather', weather.WEATHER_CHOICES)
+@pytest.mark.parametrize('current_temp', [-5.0, 0.0, 12.0])
+def test_ensemble_first_day_matches_weather_probabilities(current_weather, current_temp):
+    elevation = weather.get_elevation(*GPS_POINT)
+    _, probabilities = weather.forecast_weather_ensemble(*GPS_POINT, current_temp, '2024-05-14', current_weather, 1,
+                                                         100000, seed=2)
+    np.testing.assert_allclose(probabilities[0], next_weather(current_weather, elevation, current_temp), atol=0.01)
+
+# on the third day the temperature behind the choice depends on the weather sampled on the first day:
+# starting just below freezing, it stays above 0°C after a Clear day but not after any other
+def test_ensemble_follows_each_trajectory_temperature():
+    day_indices = weather.horizon_days(np.datetime64('2024-05-14'), 2)[1]
+    horizon = weather.get_horizon_components(*GPS_POINT, day_indices)
+    elevation = float(horizon[0].elevation)
+    adjustments = weather.WEATHER_STATE_ADJUSTMENTS
+    current_temp = 0.1 - horizon.base_change[0] - adjustments['Rainy'] - horizon.base_change[1]
+
+    # the exact distribution of each day's weather, from the chain as forecast_days runs it
+    # (the third day's choice is made from the temperature that followed the first day's weather)
+    second_day_temp = current_temp + horizon.base_change[0] + adjustments['Rainy']
+    third_day_temps = {state: second_day_temp + horizon.base_change[1] + adjustments[state] for state in weather.WEATHER_CHOICES}
+    assert third_day_temps['Clear'] > 0 > third_day_temps['Cloudy']
+    first = next_weather('Rainy', elevation, current_temp)
+    second = np.zeros(len(weather.WEATHER_CHOICES))
+    third = np.zeros(len(weather.WEATHER_CHOICES))
+    for first_state, first_probability in zip(weather.WEATHER_CHOICES, first):
+        after_first = first_probability * next_weather(first_state, elevation, second_day_temp)
+        second += after_first
+        for second_state, probability in zip(weather.WEATHER_CHOICES, after_first):
+            third += probability * next_weather(second_state, elevation, third_day_temps[first_state])
+
+    _, probabilities = weather.forecast_weather_ensemble(*GPS_POINT, current_temp, '2024-05-14', 'Rainy', 3,
+                                                         200000, seed=3)
+    np.testing.assert_allclose(probabilities, [first, second, third], atol=0.01)
@@ -1,12 +1,19 @@
+import os
+import time
 import random
 import math
-import csv
-from datetime import datetime, timedelta
+import threading
+from datetime import datetime
 
-import pandas as pd
 import numpy as np
-import PySimpleGUI as sg
-from geopy.distance import geodesic
+
+from climatology import (day_index, calendar_days, load_climatology, load_regional_climatology, load_yearly_totals,
+                         yearly_climatology, check_climatology_window)
+from locations import LocationIndex, coordinate_key, INTERPOLATION_MAX_KM
+from cache import LRUCache
+from snapshot import load_snapshot
+from explanation import SUMMARY, default_explanation, console_explanation
+from instrumentation import timed, count, profiled
 
 ########################################################################
 #
@@ -32,108 +39,423 @@ from geopy.distance import geodesic
 WEATHER_DATA_FOLDER = 'weather_database'
 ZIP_CODE_FILE = 'zip_codes.csv'
 ELEVATION_FILE = 'elevations.csv'
+CLIMATOLOGY_FILE = 'averages/climatology.npy'
+REGIONAL_CLIMATOLOGY_FILE = 'averages/regional.npy'
+REGIONAL_CELLS_FILE = 'averages/regional_cells.npy'
+YEARLY_TOTALS_FILE = 'averages/yearly.npy'
+SNAPSHOT_FILE = 'averages/snapshot.npz'
 
 # Constants
 AVG_ELR = -6.5  # Global average environmental lapse rate in °C/km
 DISTANCE_FACTOR = 0.003  # Change in temperature per kilometer from equator (global average)
 REFERENCE_ALTITUDE = 0 # Reference altitude in meters (sea level)
 
-def predict_temperature(user_latitude, user_longitude, current_temp, current_day, current_weather_state):
-    print(f"Calculating temperature prediction for {current_day} at ({user_latitude}, {user_longitude})")
+# Weather states, in the order used by probability arrays
+WEATHER_CHOICES = ['Clear', 'Cloudy', 'Rainy', 'Snowy']
+
+# Temperature change caused by the current weather state
+WEATHER_STATE_ADJUSTMENTS = {'Clear': 0.0, 'Cloudy': -0.2, 'Rainy': -0.5, 'Snowy': -1.0}
+WEATHER_STATE_EXPLANATIONS = {
+    'Clear': "The current weather state is Clear. This weather state will likely have no effect on the temperature tomorrow.",
+    'Cloudy': "The current weather state is Cloudy, which will decrease the temperature very slightly.",
+    'Rainy': "The current weather state is Rainy, which will decrease the temperature tomorrow slightly.",
+    'Snowy': "The current weather state is Snowy, which will decrease the temperature tomorrow.",
+}
+
+# Years the climatology is averaged over (see use_climatology). With neither set every year counts
+# equally (climatology.npy); otherwise the climatology is computed from the yearly totals.
+CLIMATOLOGY_WINDOW = None  # e.g. 30 = only the last 30 years of data
+CLIMATOLOGY_HALF_LIFE = None  # in years: each year is weighted by 0.5 ** (age / half-life)
+
+# Number of nearest regional climatology grid cells averaged for a location
+REGIONAL_NEIGHBOURS = 3
+
+# Forecast components for at most this many (location, day) pairs are kept
+FORECAST_CACHE_SIZE = 65536
+
+# How often (in seconds) the data files are checked for changes
+DATA_CHECK_INTERVAL = 1.0
+
+# Average the climatology over the last `window` years of data and/or weight recent years more
+# (half_life in years). With neither, every year counts equally. Applies from the next prediction.
+# Raises ValueError unless window is at least 1 and half_life is positive.
+def use_climatology(window=None, half_life=None):
+    global CLIMATOLOGY_WINDOW, CLIMATOLOGY_HALF_LIFE, _climatology
+    check_climatology_window(window, half_life)
+    with _data_lock:
+        CLIMATOLOGY_WINDOW = window
+        CLIMATOLOGY_HALF_LIFE = half_life
+        _climatology = None
+        _forecast_cache.clear()
+
+# The files a data snapshot is built from
+def snapshot_sources():
+    return {'zip_codes': ZIP_CODE_FILE, 'elevations': ELEVATION_FILE, 'climatology': CLIMATOLOGY_FILE,
+            'regional': REGIONAL_CLIMATOLOGY_FILE, 'regional_cells': REGIONAL_CELLS_FILE}
+
+# The data snapshot is loaded once (False when it is missing or out of date, in which
+# case the climatology and location data are read from their own files)
+_snapshot = None
+
+def get_snapshot():
+    global _snapshot
+    if _snapshot is None:
+        with timed('load'):
+            _snapshot = load_snapshot(SNAPSHOT_FILE, snapshot_sources()) or False
+    return _snapshot or None
+
+# The climatology is memory-mapped (or computed from the yearly totals) once and shared by every prediction
+_climatology = None
+
+# Per-day difference between the windowed and the all-years climatology change, added to the
+# regional rows so they follow the same trend (None when every year counts equally)
+_climatology_shift = None
+
+def get_climatology():
+    global _climatology, _climatology_shift
+    if _climatology is None and (CLIMATOLOGY_WINDOW is not None or CLIMATOLOGY_HALF_LIFE is not None):
+        if not os.path.exists(YEARLY_TOTALS_FILE):
+            raise FileNotFoundError(f"{YEARLY_TOTALS_FILE} is needed for a windowed or weighted climatology; "
+                                    "run data_collector.py to build it")
+        with timed('load'):
+            yearly_totals = load_yearly_totals(YEARLY_TOTALS_FILE)
+            climatology = yearly_climatology(yearly_totals, CLIMATOLOGY_WINDOW, CLIMATOLOGY_HALF_LIFE)
+            shift = climatology['change'] - yearly_climatology(yearly_totals)['change']
+            _climatology_shift = np.where(np.isnan(shift), 0.0, shift)
+            _climatology = climatology
+    elif _climatology is None:
+        _climatology_shift = None
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            _climatology = snapshot.climatology
+        else:
+            with timed('load'):
+                _climatology = load_climatology(CLIMATOLOGY_FILE)
+    return _climatology
+
+# The regional climatology is memory-mapped once (False when it has not been built)
+_regional_climatology = None
+
+def get_regional_climatology():
+    global _regional_climatology
+    if _regional_climatology is None:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            _regional_climatology = snapshot.regional or False
+        else:
+            with timed('load'):
+                _regional_climatology = load_regional_climatology(REGIONAL_CLIMATOLOGY_FILE, REGIONAL_CELLS_FILE) or False
+    return _regional_climatology or None
+
+# Climatology rows for arrays of locations and day offsets, from the nearest regional grid cells
+# where they have data for the day and from the global climatology elsewhere.
+# Returns the rows and a mask of which ones are regional.
+def get_day_climatology(user_latitudes, user_longitudes, day_indices):
+    with timed('climatology'):
+        day_rows = get_climatology()[np.asarray(day_indices)]
+        regional = get_regional_climatology()
+        if regional is None:
+            return day_rows, np.zeros(day_rows.shape, dtype=bool)
+
+        regional_rows = regional.lookup(user_latitudes, user_longitudes, day_indices, REGIONAL_NEIGHBOURS)
+        is_regional = regional_rows['count'] > 0
+        if _climatology_shift is not None:
+            regional_rows['change'] += np.where(is_regional, _climatology_shift[np.asarray(day_indices)], 0.0)
+        regional_rows[~is_regional] = np.broadcast_to(day_rows, regional_rows.shape)[~is_regional]
+        return regional_rows, is_regional
+
+# The zip code and elevation tables are loaded once and shared by every lookup
+_location_index = None
+
+def get_location_index():
+    global _location_index
+    if _location_index is None:
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            _location_index = snapshot.location_index
+        else:
+            with timed('load'):
+                _location_index = LocationIndex.from_files(ZIP_CODE_FILE, ELEVATION_FILE)
+    return _location_index
+
+# Load every data file now rather than on the first prediction
+def load_data():
+    get_climatology()
+    get_regional_climatology()
+    get_location_index().elevation_index()
+
+# Size and modification time of every data file the predictions depend on
+def data_signature():
+    signature = []
+    for path in (SNAPSHOT_FILE, CLIMATOLOGY_FILE, REGIONAL_CLIMATOLOGY_FILE, REGIONAL_CELLS_FILE, YEARLY_TOTALS_FILE,
+                 ELEVATION_FILE, ZIP_CODE_FILE):
+        try:
+            stat = os.stat(path)
+            signature.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            signature.append(None)
+    return signature
+
+_data_signature = None
+_data_checked = 0.0
+
+# Held while the loaded data is swapped out, so a reload and a clear of the forecast cache happen together
+_data_lock = threading.Lock()
+
+# Reload the data and empty the forecast cache when a data file has changed (checked at most once per interval).
+# Components being computed from the old data when the cache is emptied are not stored (see LRUCache.put).
+def check_data_files():
+    global _data_signature, _data_checked, _snapshot, _climatology, _regional_climatology, _location_index
+    if time.monotonic() - _data_checked < DATA_CHECK_INTERVAL:
+        return
+    with _data_lock:
+        # another thread may have checked while this one waited for the lock
+        now = time.monotonic()
+        if now - _data_checked < DATA_CHECK_INTERVAL:
+            return
+        _data_checked = now
+        signature = data_signature()
+        if _data_signature is not None and signature != _data_signature:
+            _snapshot = None
+            _climatology = None
+            _regional_climatology = None
+            _location_index = None
+            _forecast_cache.clear()
+        _data_signature = signature
+
+# The parts of a prediction that only depend on the location and the day of the year,
+# one record per day (fields are read as attributes, e.g. components.base_change)
+FORECAST_COMPONENTS_DTYPE = np.dtype([
+    ('elevation', '<f8'),                 # meters
+    ('change', '<f8'),                    # climatological temperature change for the day
+    ('count', '<i8'),                     # observations behind the climatological change
+    ('regional', '?'),                    # True if the change comes from nearby grid cells, False if it is global
+    ('midpoint_latitude', '<f8'),         # average position of the contributing stations
+    ('midpoint_longitude', '<f8'),
+    ('delta_z', '<f8'),                   # elevation above the reference altitude
+    ('delta_T_due_to_elevation', '<f8'),
+    ('distance', '<f8'),                  # km from the location to the midpoint
+    ('delta_T_due_to_distance', '<f8'),
+    ('base_change', '<f8'),               # predicted change before the weather state adjustment
+])
+
+# Forecast components of one location for an array of day offsets, computed together
+# as a record array (FORECAST_COMPONENTS_DTYPE) with one record per day.
+# Raises ValueError when the location has no elevation data nearby.
+def compute_horizon_components(user_latitude, user_longitude, day_indices):
     # Find elevation from user latitude and longitude
     elevation = get_elevation(user_latitude, user_longitude)
-    print(f"Elevation at ({user_latitude}, {user_longitude}): {elevation} meters")
+    if elevation is None:
+        raise ValueError(f"There is no elevation data within {INTERPOLATION_MAX_KM} km of "
+                         f"({user_latitude}, {user_longitude}), so no forecast can be made there.")
 
     # Convert types
     user_latitude = float(user_latitude)
     user_longitude = float(user_longitude)
-
-    # Import the weather data into a pandas DataFrame
-    weather_data = pd.read_csv('averages/average.csv')
+    day_indices = np.asarray(day_indices)
+
+    # Look up the climatology rows for the location and days
+    day_rows, is_regional = get_day_climatology(user_latitude, user_longitude, day_indices)
+    average_temperature_change = day_rows['change']
+    midpoint_latitude = day_rows['latitude'] # Midpoint coordinates = average lat/longitude
+    midpoint_longitude = day_rows['longitude']
+
+    with timed('adjustment'):
+        delta_z = elevation - REFERENCE_ALTITUDE
+        delta_T_due_to_elevation = AVG_ELR * (delta_z / 1000)
+
+        # Calculation of distance between two locations using Haversine formula
+        radius = 6371  # Radius of the earth in kilometers
+        delta_latitude = np.radians(user_latitude - midpoint_latitude)
+        delta_longitude = np.radians(user_longitude - midpoint_longitude)
+        a = (np.sin(delta_latitude / 2) ** 2
+            + np.cos(np.radians(midpoint_latitude)) * math.cos(math.radians(user_latitude))
+            * np.sin(delta_longitude / 2) ** 2)
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+        distance = radius * c
+
+        # Calculation of temperature change due to distance from equator using inverse square law of radiation
+        # The amount of solar radiation that reaches the earth's surface varies with latitude, with more radiation hitting the equator than the poles. 
+        delta_T_due_to_distance = -DISTANCE_FACTOR * (math.sin(math.radians(user_latitude)) ** 2)
+
+        # Adjust predicted temperature change based on elevation
+        base_change = average_temperature_change - delta_T_due_to_elevation
+
+        # Calculation of total temperature change
+        delta_T_total = delta_T_due_to_elevation + delta_T_due_to_distance
+
+        # Adjust predicted temperature change based on elevation and distance from equator
+        base_change = (base_change - delta_T_total) * 0.10
+
+    components = np.empty(day_indices.shape, dtype=FORECAST_COMPONENTS_DTYPE).view(np.recarray)
+    components.elevation = elevation
+    components.change = average_temperature_change
+    components.count = day_rows['count']
+    components.regional = is_regional
+    components.midpoint_latitude = midpoint_latitude
+    components.midpoint_longitude = midpoint_longitude
+    components.delta_z = delta_z
+    components.delta_T_due_to_elevation = delta_T_due_to_elevation
+    components.distance = distance
+    components.delta_T_due_to_distance = delta_T_due_to_distance
+    components.base_change = base_change
+    return components
+
+# Forecast components cached by (location, day of year), one single-record array per entry
+_forecast_cache = LRUCache(FORECAST_CACHE_SIZE)
+
+def get_forecast_components(user_latitude, user_longitude, day):
+    return get_horizon_components(user_latitude, user_longitude, [day])[0]
+
+# Forecast components of one location for an array of day offsets (a record array, one record per day).
+# Days already in the cache are reused; the rest are computed together in one vectorized pass.
+def get_horizon_components(user_latitude, user_longitude, day_indices):
+    check_data_files()
+    location = coordinate_key(user_latitude, user_longitude)
+    generation = _forecast_cache.generation  # before anything is computed from the loaded data
+    keys = [(*location, day) for day in np.asarray(day_indices).tolist()]
+    components = np.empty(len(keys), dtype=FORECAST_COMPONENTS_DTYPE).view(np.recarray)
+
+    missing = []
+    for position, key in enumerate(keys):
+        record = _forecast_cache.lookup(key)
+        if record is None:
+            missing.append(position)
+        else:
+            components[position] = record[0]
+
+    if missing:
+        computed = compute_horizon_components(user_latitude, user_longitude, [keys[position][-1] for position in missing])
+        components[missing] = computed
+        for position, record in zip(missing, computed):
+            # a copy, so the cache entry does not keep the whole computed horizon alive
+            _forecast_cache.put(keys[position], np.array([record], dtype=FORECAST_COMPONENTS_DTYPE), generation)
+    return components
+
+# Hit, miss and eviction counts of the forecast component cache
+def forecast_cache_stats():
+    return _forecast_cache.stats()
+
+def clear_forecast_cache():
+    _forecast_cache.clear()
+
+def predict_temperature(user_latitude, user_longitude, current_temp, current_day, current_weather_state, explain=None):
+    if explain is None:
+        explain = default_explanation()
+
+    count('predictions')
 
     # Split the user_date string into month and day
     month, day = current_day.split('-')
-    user_month_day = f'{int(month)}-{int(day)}'
-
-    # Filter the DataFrame to only include the rows that correspond to the user's date
-    filtered_data = weather_data.loc[weather_data['Month-Day'] == user_month_day]
-    average_temperature_change = filtered_data['Average Temperature Change'].mean() # Calculate the average temperature for the filtered rows
-    count = filtered_data['Count'].mean() # Calculate the average temperature for the filtered rows
-
-    print(f"First, we will find the global average temperature change for {user_month_day} through reference of data gathered through NCEI historical databases. This data is averaged from over {count} sources, from weather stations around the world.")
-    print(f"The average global temperature change for {user_month_day}: {average_temperature_change}°C")
-
-    midpoint_latitude = filtered_data['Midpoint Latitude'].iloc[0] # Midpoint coordinates = average lat/longitude 
-    midpoint_longitude = filtered_data['Midpoint Longitude'].iloc[0]
-
-    delta_z = elevation - REFERENCE_ALTITUDE
-    delta_T_due_to_elevation = AVG_ELR * (delta_z / 1000)
-
-    print(f"Next, we need calculate how much the altitude at {user_latitude}, {user_longitude} affects the temperature change.")
-    print(f"Each estimated temp change is associated with a midpoint latitude and longitude value for all stations that contributed to the average. For this particular day, that midpoint latitude is {midpoint_latitude} and {midpoint_longitude}")
-    print(f"The temperature decreases with increasing altitude at a rate known as the environmental lapse rate (ELR). ")
-
-    # Adjust predicted temperature change based on elevation
-    average_temperature_change = average_temperature_change - delta_T_due_to_elevation
-
-    print(f"Therefore, we can estimate the temperature change due to elevation by multiplying the average ELR ({AVG_ELR}) by the difference in elevation from the reference altitude (sea level)({delta_z:.2f}°C) to arrive at {average_temperature_change:.2f}°C")
-
-    # Calculation of distance between two locations using Haversine formula
-    radius = 6371  # Radius of the earth in kilometers
-    delta_latitude = math.radians(user_latitude - midpoint_latitude)
-    delta_longitude = math.radians(user_longitude - midpoint_longitude)
-    a = (math.sin(delta_latitude / 2) ** 2
-        + math.cos(math.radians(midpoint_latitude)) * math.cos(math.radians(user_latitude))
-        * math.sin(delta_longitude / 2) ** 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    distance = radius * c
+    components = get_forecast_components(user_latitude, user_longitude, day_index(int(month), int(day)))
+    return predict_from_components(user_latitude, user_longitude, current_temp, current_day, current_weather_state,
+                                   components, explain)
+
+# The rest of predict_temperature, once the components for the location and day are known
+def predict_from_components(user_latitude, user_longitude, current_temp, current_day, current_weather_state, components, explain):
+    if explain:
+        explain_components(explain, user_latitude, user_longitude, current_day, components)
+
+    # Adjust predicted temperature change based on the current weather state
+    average_temperature_change = float(components.base_change) + WEATHER_STATE_ADJUSTMENTS.get(current_weather_state, 0.0)
+    if explain:
+        explain.add('weather', "Next, we have to account for the current weather state at your location:")
+        if current_weather_state in WEATHER_STATE_EXPLANATIONS:
+            explain.add('weather', WEATHER_STATE_EXPLANATIONS[current_weather_state])
 
-    print(f"It is important to note that the calculated change in temperature at ({midpoint_latitude}, {midpoint_longitude}) is {distance:.2f} km from your location ({user_latitude}, {user_longitude}). This means actual temperature change will likely vary based on local geographical differences.")
-
-    # Calculation of temperature change due to distance from equator using inverse square law of radiation
-    # The amount of solar radiation that reaches the earth's surface varies with latitude, with more radiation hitting the equator than the poles. 
-    delta_T_due_to_distance = -DISTANCE_FACTOR * (math.sin(math.radians(user_latitude)) ** 2)
-
-    # Calculation of total temperature change
-    delta_T_total = delta_T_due_to_elevation + delta_T_due_to_distance
-
-    # Adjust predicted temperature change based on elevation and distance from equator
-    average_temperature_change = (average_temperature_change - delta_T_total) * 0.10
+    final_prediction = current_temp + average_temperature_change
+    if explain:
+        explain.add('prediction', "Therefore, the final predicted temperature is {prediction:.2f}°C.",
+                    level=SUMMARY, prediction=final_prediction)
+    return final_prediction
 
-    print(f"The amount of solar radiation that reaches the earth's surface varies with latitude by a factor of {DISTANCE_FACTOR}° per kilometer, with more radiation hitting the equator than the poles. Therefore, the temperature change due to distance from equator: {delta_T_due_to_distance}°C")
+# Record the location and day dependent steps of predict_temperature
+def explain_components(explain, user_latitude, user_longitude, current_day, components):
+    explain.add('location', "Calculating temperature prediction for {current_day} at ({latitude}, {longitude})",
+                current_day=current_day, latitude=user_latitude, longitude=user_longitude)
+    explain.add('elevation', "Elevation at ({latitude}, {longitude}): {elevation} meters",
+                latitude=user_latitude, longitude=user_longitude, elevation=components.elevation)
 
-    print("Next, we have to account for the current weather state at your location:")
-    if current_weather_state == 'Clear':
-        average_temperature_change += 0.0
-        print("The current weather state is Clear. This weather state will likely have no effect on the temperature tomorrow.")
-    elif current_weather_state == 'Cloudy':
-        average_temperature_change -= 0.2
-        print("The current weather state is Cloudy, which will decrease the temperature very slightly.")
-    elif current_weather_state == 'Rainy':
-        average_temperature_change -= 0.5
-        print("The current weather state is Rainy, which will decrease the temperature tomorrow slightly.")
-    elif current_weather_state == 'Snowy':
-        average_temperature_change -= 1.0
-        print("The current weather state is Snowy, which will decrease the temperature tomorrow.")
+    month, day = current_day.split('-')
+    user_month_day = f'{int(month)}-{int(day)}'
+    user_latitude = float(user_latitude)
+    user_longitude = float(user_longitude)
 
-    final_prediction = current_temp + average_temperature_change
-    print(f"Therefore, the final predicted temperature is {final_prediction:.2f}°C.")
-    return final_prediction
+    if components.regional:
+        explain.add('climatology', "First, we will find the regional average temperature change for {month_day} through reference of data gathered through NCEI historical databases. This data is averaged from over {count} sources, from the weather stations in the {cells} grid cells nearest to you.",
+                    month_day=user_month_day, count=components.count, cells=REGIONAL_NEIGHBOURS)
+        explain.add('climatology', "The average regional temperature change for {month_day}: {change}°C",
+                    month_day=user_month_day, change=components.change)
+    else:
+        explain.add('climatology', "First, we will find the global average temperature change for {month_day} through reference of data gathered through NCEI historical databases. This data is averaged from over {count} sources, from weather stations around the world.",
+                    month_day=user_month_day, count=components.count)
+        explain.add('climatology', "The average global temperature change for {month_day}: {change}°C",
+                    month_day=user_month_day, change=components.change)
+    explain.add('elevation', "Next, we need calculate how much the altitude at {latitude}, {longitude} affects the temperature change.",
+                latitude=user_latitude, longitude=user_longitude)
+    explain.add('elevation', "Each estimated temp change is associated with a midpoint latitude and longitude value for all stations that contributed to the average. For this particular day, that midpoint latitude is {midpoint_latitude} and {midpoint_longitude}",
+                midpoint_latitude=components.midpoint_latitude, midpoint_longitude=components.midpoint_longitude)
+    explain.add('elevation', "The temperature decreases with increasing altitude at a rate known as the environmental lapse rate (ELR). ")
+    explain.add('elevation', "Therefore, we can estimate the temperature change due to elevation by multiplying the average ELR ({elr}) by the difference in elevation from the reference altitude (sea level)({delta_z:.2f}°C) to arrive at {change:.2f}°C",
+                elr=AVG_ELR, delta_z=components.delta_z, change=components.change - components.delta_T_due_to_elevation)
+    explain.add('distance', "It is important to note that the calculated change in temperature at ({midpoint_latitude}, {midpoint_longitude}) is {distance:.2f} km from your location ({latitude}, {longitude}). This means actual temperature change will likely vary based on local geographical differences.",
+                midpoint_latitude=components.midpoint_latitude, midpoint_longitude=components.midpoint_longitude,
+                distance=components.distance, latitude=user_latitude, longitude=user_longitude)
+    explain.add('latitude', "The amount of solar radiation that reaches the earth's surface varies with latitude by a factor of {factor}° per kilometer, with more radiation hitting the equator than the poles. Therefore, the temperature change due to distance from equator: {delta}°C",
+                factor=DISTANCE_FACTOR, delta=components.delta_T_due_to_distance)
+
+# Convert 'MM-DD' date strings (or day-of-year row offsets) into climatology row offsets
+def get_day_indices(current_days):
+    current_days = np.asarray(current_days)
+    if np.issubdtype(current_days.dtype, np.integer):
+        return current_days
+    months, days = zip(*(current_day.split('-') for current_day in current_days.ravel()))
+    return day_index(np.array(months, dtype=int), np.array(days, dtype=int)).reshape(current_days.shape)
+
+# Vectorized predict_temperature over arrays of locations, days and current conditions.
+# Arguments broadcast against each other; elevations are looked up when not given.
+# Locations with no elevation data nearby are predicted as NaN.
+def predict_temperature_batch(user_latitudes, user_longitudes, current_temps, current_days, current_weather_states, elevations=None):
+    check_data_files()
+    user_latitudes, user_longitudes, current_temps, day_indices, current_weather_states = np.broadcast_arrays(
+        np.asarray(user_latitudes, dtype=float), np.asarray(user_longitudes, dtype=float),
+        np.asarray(current_temps, dtype=float), get_day_indices(current_days), np.asarray(current_weather_states))
+    count('predictions', user_latitudes.size)
+
+    if elevations is None:
+        with timed('elevation'):
+            elevations = get_location_index().interpolated_elevations(user_latitudes.ravel(), user_longitudes.ravel()).reshape(user_latitudes.shape)
+    elevations = np.broadcast_to(np.asarray(elevations, dtype=float), user_latitudes.shape)
+
+    # Climatological temperature change for each location and day
+    day_rows, is_regional = get_day_climatology(user_latitudes, user_longitudes, day_indices)
+    average_temperature_change = day_rows['change']
+
+    with timed('adjustment'):
+        # Adjust based on elevation (environmental lapse rate)
+        delta_T_due_to_elevation = AVG_ELR * ((elevations - REFERENCE_ALTITUDE) / 1000)
+        average_temperature_change = average_temperature_change - delta_T_due_to_elevation
+
+        # Adjust based on distance from the equator
+        delta_T_due_to_distance = -DISTANCE_FACTOR * (np.sin(np.radians(user_latitudes)) ** 2)
+        delta_T_total = delta_T_due_to_elevation + delta_T_due_to_distance
+        average_temperature_change = (average_temperature_change - delta_T_total) * 0.10
+
+        # Adjust based on the current weather state
+        states, state_indices = np.unique(current_weather_states, return_inverse=True)
+        state_adjustments = np.array([WEATHER_STATE_ADJUSTMENTS.get(state, 0.0) for state in states])
+        average_temperature_change = average_temperature_change + state_adjustments[state_indices.reshape(user_latitudes.shape)]
+
+    return current_temps + average_temperature_change
 
 def get_elevation(lat, lon):
-    with open(ELEVATION_FILE, newline='') as f:
-        reader = csv.reader(f)
-        next(reader)  # skip header row
-        for row in reader:
-            if row[0] == f'{lat},{lon}':
-                return float(row[1])
-    # If no matching row was found, return None
-    return None
-
-def choose_weather(current_weather, elevation, temperature):
-    # Initialize weather choices
-    weather_choices = ['Clear', 'Cloudy', 'Rainy', 'Snowy']
-    
+    # Points that are not in elevations.csv are interpolated from their nearest neighbours
+    # (None when there are none within INTERPOLATION_MAX_KM)
+    with timed('elevation'):
+        return get_location_index().interpolated_elevation(lat, lon)
+
+# Next-day weather probabilities (Clear, Cloudy, Rainy, Snowy) and the explanation for them
+def weather_probabilities(current_weather, elevation, temperature):
     # Set default probability of each weather type
     clear_prob = 0.6
     cloudy_prob = 0.25
@@ -190,32 +512,175 @@ def choose_weather(current_weather, elevation, temperature):
     else:
         explanation += " The temperature is mild, so the weather is not affected much by it."
     
-    # Choose the next day's weather
     weather_probs = [clear_prob, cloudy_prob, rainy_prob, snowy_prob]
-    chosen_weather = random.choices(weather_choices, weights=weather_probs)[0]
+    return weather_probs, explanation
+
+def choose_weather(current_weather, elevation, temperature, explain=None):
+    if explain is None:
+        explain = default_explanation()
+    with timed('weather_sampling'):
+        weather_probs, explanation = weather_probabilities(current_weather, elevation, temperature)
+
+        # Choose the next day's weather
+        chosen_weather = random.choices(WEATHER_CHOICES, weights=weather_probs)[0]
     
-    explanation += f" The predicted weather for tomorrow is {chosen_weather}."
-    print(explanation)
+    if explain:
+        explain.add('next_weather', "{explanation} The predicted weather for tomorrow is {weather}.",
+                    level=SUMMARY, explanation=explanation, weather=chosen_weather)
     return chosen_weather
 
-def get_coordinates(zip_code):
-    # Open the CSV file
-    with open(ZIP_CODE_FILE, newline='') as csvfile:
-        # Create a CSV reader
-        reader = csv.DictReader(csvfile)
-        
-        # Loop through each row in the CSV file
-        for row in reader:
-            # If the zip code in the current row matches the query zip code
-            if row["ZIP"] == zip_code:
-                # Extract the latitude and longitude from the row
-                latitude = row["LAT"]
-                longitude = row["LNG"]
-                return latitude, longitude
-    return "Invalid Zip", "Invalid Zip"
+# Elevation band used by weather_probabilities: 0 = low, 1 = moderate (> 1000 m), 2 = high (> 2000 m)
+def elevation_band(elevation):
+    elevation = np.asarray(elevation)
+    return np.where(elevation > 2000, 2, np.where(elevation > 1000, 1, 0))
+
+# Temperature band used by weather_probabilities: 0 = below freezing, 1 = above freezing, 2 = exactly 0°C, 3 = unknown (NaN)
+def temperature_band(temperature):
+    temperature = np.asarray(temperature)
+    return np.select([temperature < 0, temperature > 0, temperature < 10], [0, 1, 2], default=3)
+
+# Representative elevation and temperature for each band, used to evaluate weather_probabilities
+ELEVATION_BAND_VALUES = [0, 1500, 2500]
+TEMPERATURE_BAND_VALUES = [-1, 1, 0, float('nan')]
+
+# Transition probabilities [current weather, elevation band, temperature band, next weather], built on first use
+_weather_transitions = None
+
+def get_weather_transitions():
+    global _weather_transitions
+    if _weather_transitions is None:
+        transitions = np.array([[[weather_probabilities(current_weather, elevation, temperature)[0]
+                                  for temperature in TEMPERATURE_BAND_VALUES]
+                                 for elevation in ELEVATION_BAND_VALUES]
+                                for current_weather in WEATHER_CHOICES])
+        # random.choices normalizes its weights, so the tensor rows are normalized the same way
+        _weather_transitions = transitions / transitions.sum(axis=-1, keepdims=True)
+    return _weather_transitions
 
+def get_coordinates(zip_code):
+    with timed('coordinates'):
+        coordinates = get_location_index().coordinates(zip_code)
+    if coordinates is None:
+        return "Invalid Zip", "Invalid Zip"
+    # Extract the latitude and longitude strings from the zip code table
+    latitude, longitude = coordinates
+    return latitude, longitude
+
+
+# Forecast the `days` days after current_day ('YYYY-MM-DD'), chaining each day's predicted
+# temperature and weather into the next. Returns a list of (date, temperature, weather) rows.
+def forecast(latitude, longitude, current_temp, current_day, current_weather, days=6, explain=None):
+    return list(forecast_days(latitude, longitude, current_temp, current_day, current_weather, days, explain))
+
+# Dates ('YYYY-MM-DD') and climatology row offsets of the `days` days after start_date. The
+# dates run on across the end of the year, and Feb 29 only appears in a leap year's horizon.
+def horizon_days(start_date, days):
+    dates = np.datetime64(start_date, 'D') + np.arange(1, days + 1)
+    return np.datetime_as_string(dates, unit='D').tolist(), calendar_days(dates)[1]
+
+# forecast() one day at a time: yields each (date, temperature, weather) row as soon as it is predicted.
+# The location and the climatology of every day in the horizon are looked up once, up front,
+# so only the temperature and weather chain runs per day.
+def forecast_days(latitude, longitude, current_temp, current_day, current_weather, days=6, explain=None):
+    if explain is None:
+        explain = default_explanation()
+    count('forecasts')
+    date_object = datetime.strptime(current_day, '%Y-%m-%d')
+    if days < 1:
+        return
+    dates, day_indices = horizon_days(date_object.date(), days)
+    horizon = get_horizon_components(latitude, longitude, day_indices)
+    elevation = float(horizon[0].elevation)
+    count('predictions', days)
+
+    # Loop over the next days and predict the temperature
+    for date, components in zip(dates, horizon):
+        date_string = date[5:]
+
+        if explain:
+            explain.add('day', "\n\n\n --------- Forecast for Day: {date} ---------", level=SUMMARY, date=date_string)
+
+        # Predict the temperature for the current date
+        temperature = predict_from_components(latitude, longitude, current_temp, date_string, current_weather,
+                                              components, explain)
+        if explain:
+            explain.add('next_weather', "For tomorrow's potential weather patterns: ")
+        current_weather = choose_weather(current_weather, elevation, current_temp, explain)
+        current_temp = temperature
+
+        yield date, temperature, current_weather
+
+# forecast_days for many weather trajectories at once: each trajectory chains its own temperature
+# and weather through the horizon the way forecast_days does, with the weather sampled from a seeded
+# NumPy generator instead of choose_weather. Returns the dates and a (days, 4) array with the fraction
+# of trajectories in each weather state (WEATHER_CHOICES order) on each day. The same seed gives the
+# same result.
+def forecast_weather_ensemble(latitude, longitude, current_temp, current_day, current_weather, days=6,
+                              trajectories=10000, seed=None):
+    count('forecasts')
+    date_object = datetime.strptime(current_day, '%Y-%m-%d')
+    dates, day_indices = horizon_days(date_object.date(), days)
+    horizon = get_horizon_components(latitude, longitude, day_indices)
+    base_change = horizon.base_change
+    adjustments = np.array([WEATHER_STATE_ADJUSTMENTS[state] for state in WEATHER_CHOICES])
+
+    with timed('weather_sampling'):
+        rng = np.random.default_rng(seed)
+        transitions = get_weather_transitions()[:, int(elevation_band(horizon[0].elevation))]
+        temps = np.full(trajectories, float(current_temp))
+        states = np.full(trajectories, WEATHER_CHOICES.index(current_weather))
+        probabilities = np.empty((len(dates), len(WEATHER_CHOICES)))
+        for day in range(len(dates)):
+            # The weather is chosen from the previous day's temperature, as in forecast_days
+            bands = temperature_band(temps)
+            temps = temps + base_change[day] + adjustments[states]
+
+            # Sample each trajectory's next state by inverting the cumulative distribution of its current state
+            cumulative = np.cumsum(transitions[states, bands], axis=1)
+            draws = rng.random(trajectories)
+            states = np.minimum((draws[:, None] >= cumulative).sum(axis=1), len(WEATHER_CHOICES) - 1)
+            probabilities[day] = np.bincount(states, minlength=len(WEATHER_CHOICES)) / trajectories
+        return dates, probabilities
+
+# Events the forecast worker posts to the GUI window, each tagged with the run's generation
+FORECAST_LOCATION_EVENT = '-forecast-location-'
+FORECAST_ROW_EVENT = '-forecast-row-'
+FORECAST_DONE_EVENT = '-forecast-done-'
+FORECAST_ERROR_EVENT = '-forecast-error-'
+FORECAST_DAYS = 6
+
+# Inputs whose change cancels the forecast in flight
+FORECAST_INPUTS = ('current_temp', 'zip_c', 'current_weather', 'date_selected')
+
+# Run a forecast off the GUI thread, posting each day's row to the window as soon as it is ready.
+# Stops after the current day once `cancelled` is set.
+def forecast_worker(window, generation, cancelled, zip_code, current_temp, current_day, current_weather):
+    try:
+        if cancelled.is_set():
+            return
+        latitude, longitude = get_coordinates(zip_code)
+        if latitude == 'Invalid Zip':
+            window.write_event_value(FORECAST_ERROR_EVENT, (generation, 'Please enter a valid zip code.'))
+            return
+        window.write_event_value(FORECAST_LOCATION_EVENT, (generation, latitude, longitude))
+
+        # All explanations for the prediction are printed to the console
+        with profiled('forecast'):
+            rows = forecast_days(latitude, longitude, current_temp, current_day, current_weather,
+                                 FORECAST_DAYS, console_explanation())
+            for index, row in enumerate(rows):
+                if cancelled.is_set():
+                    return
+                window.write_event_value(FORECAST_ROW_EVENT, (generation, index, row))
+        window.write_event_value(FORECAST_DONE_EVENT, (generation,))
+    except Exception as error:
+        window.write_event_value(FORECAST_ERROR_EVENT, (generation, f'The forecast failed: {error}'))
 
 def main():
+    # The GUI toolkit and the worker thread are only needed when the window is shown
+    from concurrent.futures import ThreadPoolExecutor
+    import PySimpleGUI as sg
+
     # Get the current system date and format it as yyyy-mm-dd
     current_date = datetime.now().strftime('%Y-%m-%d')
 
@@ -224,47 +689,79 @@ def main():
 
     # Set up GUI layout
     layout = [
-        [sg.Text('Enter current temperature (Celcius):'), sg.Input(key='current_temp')],
-        [sg.Text('Enter your zip code:'), sg.Input(key='zip_c')],
-        [sg.Text('Select current weather state:'), sg.Combo(['Clear', 'Cloudy', 'Rainy', 'Snowy'], key='current_weather', default_value='Clear')],
+        [sg.Text('Enter current temperature (Celcius):'), sg.Input(key='current_temp', enable_events=True)],
+        [sg.Text('Enter your zip code:'), sg.Input(key='zip_c', enable_events=True)],
+        [sg.Text('Select current weather state:'), sg.Combo(['Clear', 'Cloudy', 'Rainy', 'Snowy'], key='current_weather', default_value='Clear', enable_events=True)],
         [sg.Text('Select current day:'), sg.Text(current_date, key='c_day'),
         sg.In(key='date_selected', enable_events=True, visible=False, default_text=current_date), 
         sg.CalendarButton('Select', target='date_selected', format='%Y-%m-%d', key='current_day')],
-        [sg.Button('Predict')],
+        [sg.Button('Predict'), sg.Text('', key='status', size=(30, 1))],
         [sg.Table(values=[], headings=['Date', 'Temperature', 'Weather'], auto_size_columns=False, num_rows=7, key='temp_table')],
         [(sg.Text('Latitude: '), sg.Text('---', key='lat')), (sg.Text('Longitude: '), sg.Text('---', key='long'))]
     ]
     window = sg.Window('Temperature Forecast', layout)
-    
+
+    # Forecasts run one at a time on a worker thread so the window stays responsive.
+    # Each run gets a new generation; events from older runs are ignored.
+    executor = ThreadPoolExecutor(max_workers=1)
+    executor.submit(load_data)
+    generation = 0
+    cancelled = threading.Event()
+    table_data = [['', '', ''] for _ in range(7)]
+
     while True:
         event, values = window.read()
 
         if event == sg.WINDOW_CLOSED:
             break
 
+        if event in FORECAST_INPUTS:
+            # The inputs changed, so the forecast in flight no longer matches them
+            cancelled.set()
+            window['status'].update('')
+
         if event == 'date_selected':
             selected_date = values['date_selected']
             window['c_day'].update(f'{selected_date}')  # Update the text next to the calendar button with the selected date
             window.Refresh()  # Force the window to update
             continue;
 
+        if event in (FORECAST_LOCATION_EVENT, FORECAST_ROW_EVENT, FORECAST_DONE_EVENT, FORECAST_ERROR_EVENT):
+            run_generation, *payload = values[event]
+            if run_generation != generation:
+                continue
+            if event == FORECAST_LOCATION_EVENT:
+                latitude, longitude = payload
+                window['lat'].update(f'{latitude}')
+                window['long'].update(f'{longitude}')
+            elif event == FORECAST_ROW_EVENT:
+                # Add the date, temperature and weather to the table as soon as each day is ready
+                index, (date, temperature, weather) = payload
+                table_data[index] = [date, f'{temperature:.2f}°', f'{weather}°']
+                window['temp_table'].update(values=table_data)
+            elif event == FORECAST_DONE_EVENT:
+                window['status'].update('')
+            else:
+                window['status'].update('')
+                sg.popup(payload[0], title='Error')
+            continue
+
         if event == 'Predict':
             current_temp = values['current_temp']
             if current_temp == '':
                 # If the user hasn't entered a temperature, display an error message
                 sg.popup('Please enter a temperature', title='Error')
                 continue
-            current_temp = float(current_temp)
+            try:
+                current_temp = float(current_temp)
+            except ValueError:
+                sg.popup('Please enter a valid temperature', title='Error')
+                continue
             current_zip = values['zip_c']
-            latitude, longitude = get_coordinates(current_zip)
             if current_zip == '':
-                # If the user hasn't entered a temperature, display an error message
+                # If the user hasn't entered a zip code, display an error message
                 sg.popup('Please enter a zip code.', title='Error')
                 continue
-            if latitude == 'Invalid Zip':
-                # If the user hasn't entered a temperature, display an error message
-                sg.popup('Please enter a valid zip code.', title='Error')
-                continue
 
             current_day = values['date_selected']
             if current_day == '':
@@ -274,41 +771,20 @@ def main():
 
             current_weather = values['current_weather']
 
-            window['lat'].update(values)
-            window['lat'].update(f'{latitude}')
-            window['long'].update(f'{longitude}')
-
-            # Clear any existing data in the table
+            # Cancel the previous run and clear any existing data in the table
+            cancelled.set()
+            cancelled = threading.Event()
+            generation += 1
             table_data = [['', '', ''] for _ in range(7)]
             window['temp_table'].update(values=table_data)
+            window['status'].update('Forecasting...')
 
-            date_object = datetime.strptime(current_day, '%Y-%m-%d')
-            # Loop over the next 6 days and predict the temperature
-            for i in range(1, 7):
-
-                # Calculate the date for the current iteration
-                date = (date_object + timedelta(days=i))
-                date_string = date.strftime('%m-%d')
-
-                print (f"\n\n\n --------- Forecast for Day: {date_string} ---------")
-
-                # Predict the temperature for the current date
-                temperature = predict_temperature(latitude, longitude, current_temp, date_string, current_weather)
-                elevation = get_elevation(latitude, longitude)
-                print("For tomorrow's potential weather patterns: ")
-                current_weather = choose_weather(current_weather, elevation, current_temp)
-                current_temp = temperature
-
-                # Add the date and temperature to the table data
-                table_data[i - 1][0] = date.strftime('%Y-%m-%d')
-                table_data[i - 1][1] = f'{temperature:.2f}°'
-                table_data[i - 1][2] = f'{current_weather}°'
-            
-            window['temp_table'].update
-            window['temp_table'].update(values=table_data)
-            #table_data = [[date.strftime('%Y-%m-%d'), str(temp) + '°'] for date, temp in temp_predictions]
-            #window['temp_table'].update(values=table_data)]
-            
+            # Predict the next 6 days on the worker thread; rows arrive as FORECAST_ROW_EVENTs
+            executor.submit(forecast_worker, window, generation, cancelled,
+                            current_zip, current_temp, current_day, current_weather)
+
+    cancelled.set()
+    executor.shutdown(wait=False, cancel_futures=True)
     window.close()
 
 if __name__ == '__main__':